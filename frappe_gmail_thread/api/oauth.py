@@ -1,3 +1,6 @@
+import json
+import os
+import threading
 from urllib.parse import quote
 
 import frappe
@@ -6,10 +9,45 @@ import google.oauth2.credentials
 import requests
 from frappe import _
 from frappe.integrations.google_oauth import GoogleOAuth
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+
+from frappe_gmail_thread.utils.quota import execute
 
 SCOPES = "https://www.googleapis.com/auth/gmail.readonly"
 
+# Pinned Gmail v1 discovery document shipped with the app, so building a client
+# never fetches it over the network and it is parsed only once per process
+GMAIL_DISCOVERY_DOCUMENT = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "config", "gmail.v1.json"
+)
+_gmail_discovery_document = None
+
+# Cached access tokens are dropped this many seconds before Google expires them
+ACCESS_TOKEN_EXPIRY_MARGIN = 300
+
+# Gmail clients built on the current thread, keyed by (Gmail Account name,
+# access token); httplib2 connections must not be shared between threads
+_thread_local = threading.local()
+
+
+def _get_gmail_clients():
+    if not hasattr(_thread_local, "gmail_clients"):
+        _thread_local.gmail_clients = {}
+    return _thread_local.gmail_clients
+
+
+def get_gmail_discovery_document():
+    global _gmail_discovery_document
+    if _gmail_discovery_document is None:
+        with open(GMAIL_DISCOVERY_DOCUMENT) as f:
+            _gmail_discovery_document = json.load(f)
+    return _gmail_discovery_document
+
+
+def build_gmail(credentials):
+    """Build a Gmail v1 client from the bundled discovery document."""
+    return build_from_document(get_gmail_discovery_document(), credentials=credentials)
+
 
 def get_authentication_url(client_id=None, redirect_uri=None):
     return {
@@ -92,9 +130,7 @@ def authorize_access(user, code=None, reauthorize=None):
                 }
 
                 credentials = google.oauth2.credentials.Credentials(**credentials_dict)
-                gmail = build(
-                    serviceName="gmail", version="v1", credentials=credentials
-                )
+                gmail = build_gmail(credentials)
 
                 check_gmail_object(gmail_account, gmail)
 
@@ -165,7 +201,7 @@ def enable_pubsub(gmail_account):
         "topicName": topic,
         "labelFilterBehavior": "include",
     }
-    gmail.users().watch(userId="me", body=body).execute()
+    execute(gmail.users().watch(userId="me", body=body))
 
 
 def disable_pubsub(gmail_account):
@@ -179,10 +215,26 @@ def disable_pubsub(gmail_account):
     if not google_settings.custom_gmail_pubsub_topic:
         frappe.throw(_("Please configure PubSub in Email Account."))
     gmail = get_gmail_object(gmail_account)
-    gmail.users().stop(userId="me").execute()
+    execute(gmail.users().stop(userId="me"))
 
 
-def get_access_token(gmail_account):
+def _get_access_token_key(account_name):
+    return f"gmail_access_token:{account_name}"
+
+
+def _drop_gmail_clients(account_name):
+    gmail_clients = _get_gmail_clients()
+    for key in [k for k in gmail_clients if k[0] == account_name]:
+        gmail_clients.pop(key, None)
+
+
+def clear_gmail_object_cache(account_name):
+    """Drop the cached access token and Gmail clients of an account."""
+    frappe.cache().delete_value(_get_access_token_key(account_name))
+    _drop_gmail_clients(account_name)
+
+
+def _request_access_token(gmail_account):
     google_settings = frappe.get_single("Google Settings")
     if isinstance(gmail_account, str):
         gmail_account = frappe.get_doc("Gmail Account", gmail_account)
@@ -217,21 +269,17 @@ def get_access_token(gmail_account):
             ).format(button_label)
         )
 
-    return r.get("access_token")
+    return r
 
 
-def get_gmail_object(gmail_account):
-    """
-    Returns an object of Google Mail along with Google Mail doc.
-    """
-    google_settings = frappe.get_doc("Google Settings")
-    if isinstance(gmail_account, str):
-        account = frappe.get_doc("Gmail Account", gmail_account)
-    else:
-        account = gmail_account
+def get_access_token(gmail_account):
+    return _request_access_token(gmail_account).get("access_token")
 
+
+def _build_gmail_object(account, token):
+    google_settings = frappe.get_doc("Google Settings")
     credentials_dict = {
-        "token": get_access_token(account),
+        "token": token,
         "refresh_token": account.get_password(
             fieldname="refresh_token", raise_exception=False
         ),
@@ -244,16 +292,48 @@ def get_gmail_object(gmail_account):
     }
 
     credentials = google.oauth2.credentials.Credentials(**credentials_dict)
-    gmail = build(serviceName="gmail", version="v1", credentials=credentials)
+    return build_gmail(credentials)
+
+
+def get_gmail_object(gmail_account):
+    """Returns an object of Google Mail along with Google Mail doc."""
+    if isinstance(gmail_account, str):
+        account = frappe.get_doc("Gmail Account", gmail_account)
+    else:
+        account = gmail_account
+
+    # tokens are cached until shortly before they expire, and the client
+    # built for a token is reused within the thread
+    cache_key = _get_access_token_key(account.name)
+    token = frappe.cache().get_value(cache_key, expires=True)
+    gmail_clients = _get_gmail_clients()
+    if token:
+        gmail = gmail_clients.get((account.name, token))
+        if not gmail:
+            _drop_gmail_clients(account.name)
+            gmail = _build_gmail_object(account, token)
+            gmail_clients[(account.name, token)] = gmail
+        return gmail
+
+    response = _request_access_token(account)
+    token = response.get("access_token")
+    gmail = _build_gmail_object(account, token)
 
     check_gmail_object(account, gmail)
 
+    # only tokens that passed the profile check are cached
+    expires_in = int(response.get("expires_in") or 0) - ACCESS_TOKEN_EXPIRY_MARGIN
+    if token and expires_in > 0:
+        frappe.cache().set_value(cache_key, token, expires_in_sec=expires_in)
+        _drop_gmail_clients(account.name)
+        gmail_clients[(account.name, token)] = gmail
+
     return gmail
 
 
 def check_gmail_object(account, gmail):
     try:
-        gmail = gmail.users().getProfile(userId="me").execute()
+        gmail = execute(gmail.users().getProfile(userId="me"))
         # get email address from the response
         email = gmail["emailAddress"]
         # check if email address is same as the email account email
@@ -0,0 +1,14 @@
+from frappe_gmail_thread.utils.users import invalidate_user_map
+
+
+def on_change(doc, method=None):
+    if doc.has_value_changed("email") or doc.has_value_changed("user_type"):
+        invalidate_user_map()
+
+
+def after_rename(doc, method=None, old=None, new=None, merge=False):
+    invalidate_user_map()
+
+
+def on_trash(doc, method=None):
+    invalidate_user_map()
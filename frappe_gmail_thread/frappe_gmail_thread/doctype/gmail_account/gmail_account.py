@@ -9,7 +9,11 @@ from frappe import _
 from frappe.model.document import Document
 from frappe.utils.background_jobs import is_job_enqueued
 
-from frappe_gmail_thread.api.oauth import disable_pubsub, enable_pubsub
+from frappe_gmail_thread.api.oauth import (
+    clear_gmail_object_cache,
+    disable_pubsub,
+    enable_pubsub,
+)
 from frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_thread.gmail_thread import (
     sync_labels,
 )
@@ -21,6 +25,7 @@ class GmailAccount(Document):
         self.email_id = frappe.get_value("User", self.linked_user, "email")
 
     def on_trash(self):
+        frappe.db.delete("Gmail Sync Retry", {"gmail_account": self.name})
         if not self.gmail_enabled:
             return
         if not self.refresh_token:
@@ -30,6 +35,9 @@ class GmailAccount(Document):
             return
         disable_pubsub(self)
 
+    def after_delete(self):
+        clear_gmail_object_cache(self.name)
+
     def validate(self):
         if self.gmail_enabled:
             google_settings = frappe.get_single("Google Settings")
@@ -77,6 +85,9 @@ class GmailAccount(Document):
                         "Please set Client ID and Client Secret in Google Settings to enable Gmail"
                     )
                 )
+        if self.has_value_changed("refresh_token"):
+            # tokens minted from the previous grant must not be reused
+            clear_gmail_object_cache(self.name)
         if self.has_value_changed("refresh_token") and self.refresh_token:
             sync_labels(self, should_save=False)
             google_settings = frappe.get_single("Google Settings")
@@ -138,6 +149,17 @@ class GmailAccount(Document):
                     enable_pubsub(self)
                 else:
                     frappe.msgprint(_("Please select at least one label."))
+        if self.has_value_changed("last_historyid") and not self.last_historyid:
+            # a full resync starts the paginated initial sync from scratch
+            self.reset_initial_sync_state()
+
+    def reset_initial_sync_state(self):
+        self.initial_sync_historyid = 0
+        for label in self.labels:
+            label.initial_sync_completed = 0
+            label.sync_page_token = None
+            label.sync_last_thread_id = None
+            label.sync_threads_done = 0
 
 
 @frappe.whitelist()  # nosemgrep
@@ -0,0 +1,197 @@
+# Copyright (c) 2026, rtCamp and contributors
+# For license information, please see license.txt
+
+from typing import Dict, List
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_to_date, now_datetime
+
+# Attempts before a failed item is given up on and logged
+MAX_RETRY_ATTEMPTS = 8
+
+# Backoff doubles from RETRY_BACKOFF_SECONDS after every failed attempt
+RETRY_BACKOFF_SECONDS = 60
+MAX_RETRY_BACKOFF_SECONDS = 6 * 60 * 60
+
+# Threads handed to a background batch job are queued with this reason until
+# the job stores them; if it never does, the sync retries them once due
+BATCH_JOB_REASON = "Queued for a batch job"
+BATCH_JOB_RETRY_SECONDS = 6 * 60 * 60
+
+
+class GmailSyncRetry(Document):
+    pass
+
+
+def on_doctype_update():
+    # due items are looked up per account, failures are matched by item
+    frappe.db.add_index("Gmail Sync Retry", ["gmail_account", "next_attempt_after"])
+    frappe.db.add_index("Gmail Sync Retry", ["gmail_account", "item_type", "item_id"])
+
+
+def get_retry_backoff_seconds(attempts: int) -> int:
+    return min(
+        MAX_RETRY_BACKOFF_SECONDS, RETRY_BACKOFF_SECONDS * 2 ** max(0, attempts - 1)
+    )
+
+
+def _get_queued_items(gmail_account_name: str, item_type: str, item_ids: List[str]):
+    return {
+        row.item_id: row
+        for row in frappe.get_all(
+            "Gmail Sync Retry",
+            filters={
+                "gmail_account": gmail_account_name,
+                "item_type": item_type,
+                "item_id": ["in", list(item_ids)],
+            },
+            fields=["name", "item_id", "attempts"],
+        )
+    }
+
+
+def _insert_item(
+    gmail_account_name: str, item_type: str, item_id: str, thread_id: str, values
+):
+    frappe.get_doc(
+        {
+            "doctype": "Gmail Sync Retry",
+            "gmail_account": gmail_account_name,
+            "item_type": item_type,
+            "item_id": item_id,
+            "thread_id": thread_id,
+            **values,
+        }
+    ).insert(ignore_permissions=True)
+
+
+def queue_failed_items(
+    gmail_account_name: str,
+    item_type: str,
+    errors: Dict[str, Exception],
+    thread_ids: Dict[str, str] = None,
+):
+    """Queue items whose fetch failed for a later sync, dropping those out of attempts."""
+    if not errors:
+        return
+    thread_ids = thread_ids or {}
+    queued = _get_queued_items(gmail_account_name, item_type, list(errors))
+    for item_id, error in errors.items():
+        row = queued.get(item_id)
+        attempts = (row.attempts if row else 0) + 1
+        if attempts > MAX_RETRY_ATTEMPTS:
+            frappe.log_error(
+                f"Gave up on Gmail {item_type.lower()} {item_id} of {gmail_account_name} "
+                f"after {MAX_RETRY_ATTEMPTS} attempts: {error}",
+                "Gmail Thread Sync Error",
+            )
+            frappe.db.delete("Gmail Sync Retry", row.name)
+            continue
+        values = {
+            "attempts": attempts,
+            "next_attempt_after": add_to_date(
+                now_datetime(), seconds=get_retry_backoff_seconds(attempts)
+            ),
+            "last_error": str(error),
+        }
+        if row:
+            frappe.db.set_value("Gmail Sync Retry", row.name, values)
+            continue
+        _insert_item(
+            gmail_account_name, item_type, item_id, thread_ids.get(item_id), values
+        )
+
+
+def defer_items(
+    gmail_account_name: str,
+    item_type: str,
+    item_ids: List[str],
+    seconds: int,
+    reason: str,
+    thread_ids: Dict[str, str] = None,
+):
+    """Queue items that were not fetched yet for `seconds`, without using up an attempt."""
+    if not item_ids:
+        return
+    thread_ids = thread_ids or {}
+    queued = _get_queued_items(gmail_account_name, item_type, item_ids)
+    values = {
+        "next_attempt_after": add_to_date(now_datetime(), seconds=seconds),
+        "last_error": reason,
+    }
+    for item_id in item_ids:
+        row = queued.get(item_id)
+        if row:
+            frappe.db.set_value("Gmail Sync Retry", row.name, values)
+            continue
+        _insert_item(
+            gmail_account_name,
+            item_type,
+            item_id,
+            thread_ids.get(item_id),
+            {"attempts": 0, **values},
+        )
+
+
+def get_due_items(gmail_account_name: str, limit: int = 500) -> List[Dict]:
+    """Return the queued items of the account whose backoff has passed, oldest first."""
+    return frappe.get_all(
+        "Gmail Sync Retry",
+        filters={
+            "gmail_account": gmail_account_name,
+            "next_attempt_after": ["<=", now_datetime()],
+        },
+        fields=["name", "item_type", "item_id", "thread_id"],
+        order_by="next_attempt_after asc",
+        limit=limit,
+    )
+
+
+def remove_retried_items(items: List[Dict], started_at):
+    """Drop the given queued items unless they failed again since `started_at`."""
+    if not items:
+        return
+    frappe.db.delete(
+        "Gmail Sync Retry",
+        {
+            "name": ["in", [item.name for item in items]],
+            "next_attempt_after": ["<=", started_at],
+        },
+    )
+
+
+def queue_batch_items(gmail_account_name: str, thread_ids: List[str]):
+    """Queue threads handed to a background batch job, see BATCH_JOB_REASON."""
+    defer_items(
+        gmail_account_name,
+        "Thread",
+        thread_ids,
+        BATCH_JOB_RETRY_SECONDS,
+        BATCH_JOB_REASON,
+    )
+
+
+def remove_batch_items(gmail_account_name: str, thread_ids: List[str]):
+    """Drop threads a batch job has stored; ones that failed or were deferred stay queued."""
+    if not thread_ids:
+        return
+    frappe.db.delete(
+        "Gmail Sync Retry",
+        {
+            "gmail_account": gmail_account_name,
+            "item_type": "Thread",
+            "item_id": ["in", list(thread_ids)],
+            "last_error": BATCH_JOB_REASON,
+        },
+    )
+
+
+def has_batch_items(gmail_account_name: str) -> bool:
+    """Whether batch jobs of the account still have threads to store."""
+    return bool(
+        frappe.db.exists(
+            "Gmail Sync Retry",
+            {"gmail_account": gmail_account_name, "last_error": BATCH_JOB_REASON},
+        )
+    )
@@ -0,0 +1,118 @@
+# Copyright (c) 2026, rtCamp and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, get_datetime, now_datetime
+
+from frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_sync_retry.gmail_sync_retry import (
+    BATCH_JOB_REASON,
+    MAX_RETRY_ATTEMPTS,
+    MAX_RETRY_BACKOFF_SECONDS,
+    RETRY_BACKOFF_SECONDS,
+    defer_items,
+    get_due_items,
+    get_retry_backoff_seconds,
+    has_batch_items,
+    queue_batch_items,
+    queue_failed_items,
+    remove_batch_items,
+    remove_retried_items,
+)
+
+
+class TestGmailSyncRetry(FrappeTestCase):
+    def setUp(self):
+        self.account = frappe.db.exists("Gmail Account", frappe.session.user)
+        if not self.account:
+            self.account = (
+                frappe.get_doc({"doctype": "Gmail Account"})
+                .insert(ignore_permissions=True)
+                .name
+            )
+        frappe.db.delete("Gmail Sync Retry", {"gmail_account": self.account})
+
+    def get_item(self, item_id):
+        return frappe.db.get_value(
+            "Gmail Sync Retry",
+            {"gmail_account": self.account, "item_id": item_id},
+            ["attempts", "next_attempt_after", "last_error", "thread_id"],
+            as_dict=True,
+        )
+
+    def make_due(self):
+        frappe.db.set_value(
+            "Gmail Sync Retry",
+            {"gmail_account": self.account},
+            "next_attempt_after",
+            add_to_date(now_datetime(), seconds=-1),
+        )
+
+    def test_backoff(self):
+        self.assertEqual(get_retry_backoff_seconds(1), RETRY_BACKOFF_SECONDS)
+        self.assertEqual(get_retry_backoff_seconds(3), RETRY_BACKOFF_SECONDS * 4)
+        self.assertEqual(get_retry_backoff_seconds(50), MAX_RETRY_BACKOFF_SECONDS)
+
+    def test_queue_failed_items(self):
+        queue_failed_items(
+            self.account, "Message", {"m1": Exception("boom")}, {"m1": "t1"}
+        )
+        item = self.get_item("m1")
+        self.assertEqual(item.attempts, 1)
+        self.assertEqual(item.thread_id, "t1")
+        self.assertEqual(item.last_error, "boom")
+        self.assertGreater(get_datetime(item.next_attempt_after), now_datetime())
+        self.assertFalse(get_due_items(self.account))
+
+        queue_failed_items(self.account, "Message", {"m1": Exception("again")})
+        item = self.get_item("m1")
+        self.assertEqual(item.attempts, 2)
+        self.assertEqual(item.last_error, "again")
+
+    def test_give_up_after_max_attempts(self):
+        queue_failed_items(self.account, "Thread", {"t1": Exception("boom")})
+        frappe.db.set_value(
+            "Gmail Sync Retry",
+            {"gmail_account": self.account, "item_id": "t1"},
+            "attempts",
+            MAX_RETRY_ATTEMPTS,
+        )
+        queue_failed_items(self.account, "Thread", {"t1": Exception("boom")})
+        self.assertIsNone(self.get_item("t1"))
+
+    def test_defer_items(self):
+        queue_failed_items(self.account, "Thread", {"t1": Exception("boom")})
+        defer_items(self.account, "Thread", ["t1", "t2"], 60, "Rate limited")
+        self.assertEqual(self.get_item("t1").attempts, 1)
+        self.assertEqual(self.get_item("t2").attempts, 0)
+        self.assertEqual(self.get_item("t2").last_error, "Rate limited")
+
+    def test_remove_retried_items(self):
+        queue_failed_items(
+            self.account,
+            "Thread",
+            {"t1": Exception("boom"), "t2": Exception("boom")},
+        )
+        self.make_due()
+        items = get_due_items(self.account)
+        self.assertEqual({item.item_id for item in items}, {"t1", "t2"})
+
+        started_at = now_datetime()
+        # t2 fails again while it is retried
+        queue_failed_items(self.account, "Thread", {"t2": Exception("again")})
+        remove_retried_items(items, started_at)
+        self.assertIsNone(self.get_item("t1"))
+        self.assertEqual(self.get_item("t2").attempts, 2)
+
+    def test_batch_items(self):
+        queue_batch_items(self.account, ["t1", "t2"])
+        self.assertTrue(has_batch_items(self.account))
+        self.assertEqual(self.get_item("t1").last_error, BATCH_JOB_REASON)
+        self.assertFalse(get_due_items(self.account))
+
+        # the job failed to store t2, it stays queued as a failure
+        queue_failed_items(self.account, "Thread", {"t2": Exception("boom")})
+        remove_batch_items(self.account, ["t1", "t2"])
+        self.assertIsNone(self.get_item("t1"))
+        self.assertEqual(self.get_item("t2").last_error, "boom")
+        self.assertFalse(has_batch_items(self.account))
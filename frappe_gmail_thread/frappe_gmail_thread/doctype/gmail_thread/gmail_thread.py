@@ -2,30 +2,127 @@
 # For license information, please see license.txt
 
 
+import threading
+from contextlib import contextmanager
+
 import frappe
-import frappe.share
 import googleapiclient.errors
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils import get_string_between
+from frappe.utils import get_string_between, now, now_datetime, sanitize_html
 
 from frappe_gmail_thread.api.oauth import get_gmail_object
+from frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_sync_retry.gmail_sync_retry import (
+    defer_items,
+    get_due_items,
+    has_batch_items,
+    queue_batch_items,
+    queue_failed_items,
+    remove_batch_items,
+    remove_retried_items,
+)
 from frappe_gmail_thread.utils.helpers import (
     AlreadyExistsError,
+    GmailThreadResolver,
     create_new_email,
-    find_gmail_thread,
+    discard_attachment_files,
+    get_message_header,
+    get_synced_gmail_message_ids,
+    get_threads_by_message_ids,
+    normalize_message_id,
+    parse_raw_email,
     process_attachments,
+    remove_written_files,
     replace_inline_images,
+    track_written_files,
+)
+from frappe_gmail_thread.utils.concurrency import run_pipeline
+from frappe_gmail_thread.utils.parse_pool import (
+    get_parse_processes,
+    parse_pool_scope,
+    parse_raw_emails,
 )
+from frappe_gmail_thread.utils.quota import execute
+from frappe_gmail_thread.utils.users import get_system_users
 from googleapiclient.http import BatchHttpRequest
 from datetime import datetime, timedelta, timezone
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 import time
 
 logger = frappe.logger("gmail_sync")
 
 SCOPES = "https://www.googleapis.com/auth/gmail.readonly"
 
+# Number of threads/messages fetched per batch when no batch size is configured
+DEFAULT_BATCH_SIZE = 50
+
+# Bounds and steps of the adaptive (AIMD) batch size learned per account;
+# Gmail accepts at most 100 requests in one batch
+MIN_BATCH_SIZE = 5
+MAX_BATCH_SIZE = 100
+BATCH_SIZE_INCREASE = 5
+BATCH_SIZE_DECREASE_FACTOR = 0.5
+BATCH_SIZE_TTL = 24 * 60 * 60
+
+# Rate limited rounds one adaptive fetch retries before deferring the rest
+MAX_RATE_LIMITED_ROUNDS = 5
+
+# Seconds after which the lock of a sync that stopped refreshing it expires;
+# a running sync refreshes it every SYNC_LOCK_REFRESH_SECONDS, so the lock of
+# a killed job does not hold the account back for long
+SYNC_LOCK_TIMEOUT = 5 * 60
+SYNC_LOCK_REFRESH_SECONDS = 60
+
+# Extend or delete the lock only while it holds the token of this sync
+REFRESH_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# Error reasons Gmail returns (with 403 or 429) when a quota is exceeded
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+# Largest page sizes accepted by threads().list and history().list
+THREADS_PAGE_SIZE = 500
+HISTORY_PAGE_SIZE = 500
+
+# Seconds a background job storing a chunk of threads may run
+BATCH_JOB_TIMEOUT = 30 * 60
+
+# Headers requested with format="metadata" to route a message before downloading it
+ROUTING_HEADERS = ["Message-ID", "References", "In-Reply-To"]
+
+# Savepoint each message and thread of a batch is stored in, so one that
+# cannot be stored is rolled back alone, see _call_in_savepoint
+STORE_SAVEPOINT = "gmail_store_item"
+
+# Attachment shares of a thread above which they are inserted by a background job
+SHARE_IN_BACKGROUND_PAIRS = 2000
+DOCSHARE_FIELDS = [
+    "name",
+    "share_doctype",
+    "share_name",
+    "user",
+    "read",
+    "write",
+    "share",
+    "submit",
+    "everyone",
+    "notify_by_email",
+    "owner",
+    "modified_by",
+    "creation",
+    "modified",
+]
+
 
 class GmailThread(Document):
     def has_value_changed(self, fieldname):
@@ -48,27 +145,30 @@ class GmailThread(Document):
             return True
         return super().has_value_changed(fieldname)
 
+    def validate(self):
+        self.sanitize_email_content()
+
+    def sanitize_email_content(self):
+        # synced emails are sanitised while parsing (the field ignores the XSS
+        # filter), content written any other way is sanitised here
+        doc_before_save = self.get_doc_before_save()
+        old_content = (
+            {email.name: email.content for email in doc_before_save.emails}
+            if doc_before_save
+            else {}
+        )
+        for email in self.emails:
+            if email.flags.content_sanitized:
+                continue
+            if email.name in old_content and old_content[email.name] == email.content:
+                continue
+            email.content = sanitize_html(email.content)
+
     def before_save(self):
         if self.has_value_changed("involved_users"):
-            # give permission of all files to all involved users
-            attachments = frappe.get_all(
-                "File",
-                filters={
-                    "attached_to_doctype": "Gmail Thread",
-                    "attached_to_name": self.name,
-                },
-                fields=["name"],
+            share_thread_attachments(
+                self.name, self.owner, [user.account for user in self.involved_users]
             )
-            for attachment in attachments:
-                for user in self.involved_users:
-                    if user.account == self.owner:
-                        continue
-                    frappe.share.add_docshare(
-                        "File",
-                        attachment.name,
-                        user.account,
-                        flags={"ignore_share_permission": True},
-                    )
         if self.has_value_changed("reference_doctype") and self.has_value_changed(
             "reference_name"
         ):
@@ -96,6 +196,138 @@ class GmailThread(Document):
                 self.status = "Open"
 
 
+def share_thread_attachments(
+    thread_name: str, thread_owner: str, accounts: List[str], defer_large: bool = True
+):
+    """Share the files of a thread with the given involved users."""
+    accounts = [account for account in set(accounts) if account != thread_owner]
+    if not accounts:
+        return
+    files = frappe.get_all(
+        "File",
+        filters={
+            "attached_to_doctype": "Gmail Thread",
+            "attached_to_name": thread_name,
+        },
+        pluck="name",
+    )
+    if not files:
+        return
+    if defer_large and len(files) * len(accounts) > SHARE_IN_BACKGROUND_PAIRS:
+        frappe.enqueue(
+            "frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_thread.gmail_thread.share_thread_attachments",
+            thread_name=thread_name,
+            thread_owner=thread_owner,
+            accounts=accounts,
+            defer_large=False,
+            enqueue_after_commit=True,
+        )
+        return
+
+    shared = {
+        (row.share_name, row.user)
+        for row in frappe.get_all(
+            "DocShare",
+            filters={
+                "share_doctype": "File",
+                "share_name": ["in", files],
+                "user": ["in", accounts],
+            },
+            fields=["share_name", "user"],
+        )
+    }
+    # same values frappe.share.add_docshare saves for a read share
+    timestamp = now()
+    user = frappe.session.user
+    values = [
+        (
+            frappe.generate_hash(length=10),
+            "File",
+            file_name,
+            account,
+            1,
+            0,
+            0,
+            0,
+            0,
+            0,
+            user,
+            user,
+            timestamp,
+            timestamp,
+        )
+        for file_name in files
+        for account in accounts
+        if (file_name, account) not in shared
+    ]
+    if values:
+        frappe.db.bulk_insert("DocShare", DOCSHARE_FIELDS, values)
+
+
+def _insert_thread_child(child, thread_name: str, parentfield: str, idx: int):
+    child.parent = thread_name
+    child.parenttype = "Gmail Thread"
+    child.parentfield = parentfield
+    child.idx = idx
+    if not child.creation:
+        child.creation = now()
+    child.modified = child.creation
+    child.owner = child.modified_by = frappe.session.user
+    # the checks Document.save() runs on child rows
+    child._validate_length()
+    child._sanitize_content()
+    child.db_insert()
+
+
+def append_emails_to_thread(
+    thread_name: str,
+    thread_owner: str,
+    emails: list,
+    accounts: List[str],
+    thread_values: Dict[str, Any],
+):
+    """Insert new emails into a thread without saving the whole document."""
+    idx = frappe.db.count(
+        "Single Email CT",
+        {"parent": thread_name, "parenttype": "Gmail Thread", "parentfield": "emails"},
+    )
+    for email in emails:
+        idx += 1
+        _insert_thread_child(email, thread_name, "emails", idx)
+
+    frappe.db.set_value(
+        "Gmail Thread", thread_name, thread_values, update_modified=False
+    )
+    add_involved_users_to_thread(thread_name, accounts, thread_owner)
+
+
+def add_involved_users_to_thread(thread_name: str, accounts: List[str], thread_owner: str = None):
+    """Add the missing involved users to a thread and share its files with them."""
+    linked_accounts = frappe.get_all(
+        "Involved User",
+        filters={"parent": thread_name, "parenttype": "Gmail Thread"},
+        fields=["account", "idx"],
+    )
+    existing_accounts = {row.account for row in linked_accounts}
+    idx = max([row.idx for row in linked_accounts] or [0])
+    new_accounts = [
+        account for account in dict.fromkeys(accounts) if account not in existing_accounts
+    ]
+    if not new_accounts:
+        return
+    for account in new_accounts:
+        idx += 1
+        involved_user = frappe.new_doc("Involved User")
+        involved_user.account = account
+        _insert_thread_child(involved_user, thread_name, "involved_users", idx)
+
+    if thread_owner is None:
+        thread_owner = frappe.db.get_value("Gmail Thread", thread_name, "owner")
+    share_thread_attachments(
+        thread_name, thread_owner, list(existing_accounts) + new_accounts
+    )
+
+
 @frappe.whitelist(methods=["POST"])
 def sync_labels(account_name, should_save=True):
     if isinstance(account_name, str):
@@ -104,7 +336,7 @@ def sync_labels(account_name, should_save=True):
         gmail_account = account_name
 
     gmail = get_gmail_object(gmail_account)
-    labels = gmail.users().labels().list(userId="me").execute()
+    labels = execute(gmail.users().labels().list(userId="me"))
 
     available_labels = [x.label_id for x in gmail_account.labels]
 
@@ -127,13 +359,43 @@ def _get_google_settings():
         return None
 
 
+def _get_sync_settings():
+    settings = frappe._dict(
+        max_threads_per_label=0,
+        batch_size=DEFAULT_BATCH_SIZE,
+        batch_jobs=False,
+        pipeline_workers=0,
+    )
+    google_settings = _get_google_settings()
+    if not google_settings:
+        return settings
+    try:
+        settings.max_threads_per_label = int(getattr(google_settings, "custom_gmail_max_threads_per_label", 0) or 0)
+    except Exception:
+        settings.max_threads_per_label = 0
+    try:
+        batch_size = int(getattr(google_settings, "custom_gmail_batch_size", 0) or 0)
+    except Exception:
+        batch_size = 0
+    if batch_size > 0:
+        settings.batch_size = batch_size
+    settings.batch_jobs = bool(getattr(google_settings, "custom_gmail_batch_jobs", 0))
+    try:
+        settings.pipeline_workers = max(0, int(getattr(google_settings, "custom_gmail_pipeline_workers", 0) or 0))
+    except Exception:
+        settings.pipeline_workers = 0
+    return settings
+
+
 def _get_retry_after_key(gmail_account_name: str) -> str:
     return f"gmail_retry_after_until:{gmail_account_name}"
 
 
 def _get_wait_seconds_if_rate_limited(gmail_account_name: str) -> int:
     cache = frappe.cache()
-    retry_until = cache.get_value(_get_retry_after_key(gmail_account_name))
+    # expires=True reads Redis, not the job's first copy, so windows set by
+    # other jobs are seen
+    retry_until = cache.get_value(_get_retry_after_key(gmail_account_name), expires=True)
     if not retry_until:
         return 0
     try:
@@ -151,13 +413,193 @@ def _set_rate_limit_until(gmail_account_name: str, seconds: int) -> None:
     frappe.cache().set_value(_get_retry_after_key(gmail_account_name), until.isoformat())
 
 
+def _get_sync_lock_key(gmail_account_name: str) -> str:
+    return frappe.cache().make_key(f"gmail_sync_lock:{gmail_account_name}")
+
+
+def _acquire_sync_lock(key: str) -> str:
+    """Return this sync's lock token, or None if another sync holds the lock."""
+    token = frappe.generate_hash(length=20)
+    if frappe.cache().set(key, token, nx=True, ex=SYNC_LOCK_TIMEOUT):
+        return token
+    return None
+
+
+def _refresh_sync_lock(key: str, token: str, stop: threading.Event) -> None:
+    # runs on its own thread, which has no site: only the cache is used
+    while not stop.wait(SYNC_LOCK_REFRESH_SECONDS):
+        try:
+            if not frappe.cache().eval(REFRESH_LOCK_SCRIPT, 1, key, token, SYNC_LOCK_TIMEOUT):
+                logger.warning(f"gmail_sync: lost the sync lock {key}")
+                return
+        except Exception:
+            logger.warning(f"gmail_sync: could not refresh the sync lock {key}", exc_info=True)
+
+
+def _release_sync_lock(key: str, token: str) -> None:
+    frappe.cache().eval(RELEASE_LOCK_SCRIPT, 1, key, token)
+
+
+@contextmanager
+def _hold_sync_lock(gmail_account_name: str):
+    """Hold the account's sync lock while the block runs; yields False if it is held."""
+    key = _get_sync_lock_key(gmail_account_name)
+    token = _acquire_sync_lock(key)
+    if not token:
+        yield False
+        return
+    stop = threading.Event()
+    refresher = threading.Thread(
+        target=_refresh_sync_lock, args=(key, token, stop), daemon=True
+    )
+    refresher.start()
+    try:
+        yield True
+    finally:
+        stop.set()
+        refresher.join()
+        _release_sync_lock(key, token)
+
+
+def _get_batch_size_key(gmail_account_name: str) -> str:
+    return f"gmail_batch_size:{gmail_account_name}"
+
+
+def get_batch_size(gmail_account_name: str, default: int = DEFAULT_BATCH_SIZE) -> int:
+    """Return the learned batch size of the account, or `default`."""
+    batch_size = frappe.cache().get_value(
+        _get_batch_size_key(gmail_account_name), expires=True
+    )
+    try:
+        batch_size = int(batch_size or default)
+    except (TypeError, ValueError):
+        batch_size = default
+    return min(MAX_BATCH_SIZE, max(MIN_BATCH_SIZE, batch_size))
+
+
+def _update_batch_size(gmail_account_name: str, rate_limited: bool, default: int = DEFAULT_BATCH_SIZE) -> int:
+    """Grow or shrink the account's batch size after a batch and return it."""
+    batch_size = get_batch_size(gmail_account_name, default)
+    if rate_limited:
+        batch_size = max(MIN_BATCH_SIZE, int(batch_size * BATCH_SIZE_DECREASE_FACTOR))
+    else:
+        batch_size = min(MAX_BATCH_SIZE, batch_size + BATCH_SIZE_INCREASE)
+    frappe.cache().set_value(
+        _get_batch_size_key(gmail_account_name), batch_size, expires_in_sec=BATCH_SIZE_TTL
+    )
+    return batch_size
+
+
+@frappe.whitelist()
+def get_batch_sizes() -> Dict[str, Dict[str, Any]]:
+    """Current adaptive batch size and retry-after wait of every Gmail Account."""
+    frappe.only_for("System Manager")
+    default = _get_sync_settings().batch_size
+    return {
+        name: {
+            "batch_size": get_batch_size(name, default),
+            "rate_limited_for_s": _get_wait_seconds_if_rate_limited(name),
+        }
+        for name in frappe.get_all("Gmail Account", pluck="name")
+    }
+
+
+def _is_not_found_error(e: googleapiclient.errors.HttpError) -> bool:
+    if getattr(getattr(e, "resp", None), "status", None) == 404:
+        return True
+    for error in getattr(e, "error_details", None) or []:
+        if isinstance(error, dict) and error.get("reason") == "notFound":
+            return True
+    return False
+
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    if not isinstance(e, googleapiclient.errors.HttpError):
+        return False
+    status = getattr(getattr(e, "resp", None), "status", None)
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    for error in getattr(e, "error_details", None) or []:
+        if isinstance(error, dict) and error.get("reason") in RATE_LIMIT_REASONS:
+            return True
+    return False
+
+
+def _defer_if_rate_limited(gmail_account_name: str, e: googleapiclient.errors.HttpError) -> bool:
+    """Back off for a rate limit error; returns False for any other error."""
+    if not _is_rate_limit_error(e):
+        return False
+    retry_after = e.resp.get("retry-after")
+    retry_after_seconds = int(retry_after) if retry_after and str(retry_after).isdigit() else 60
+    _set_rate_limit_until(gmail_account_name, retry_after_seconds)
+    _update_batch_size(gmail_account_name, rate_limited=True)
+    logger.info(
+        f"gmail_sync: rate limited; setting retry-after {retry_after_seconds}s (account={gmail_account_name})"
+    )
+    return True
+
+
+def _queue_fetch_errors(
+    gmail_account, item_type: str, errors: Dict[str, Exception], thread_ids: Dict[str, str] = None
+):
+    """Queue items that failed inside a batch for retry; deleted items are dropped."""
+    errors = {
+        item_id: error for item_id, error in errors.items() if not _is_not_found_error(error)
+    }
+    if errors:
+        logger.info(
+            f"gmail_sync: queued {len(errors)} failed {item_type.lower()}s for retry "
+            f"(account={gmail_account.name})"
+        )
+    queue_failed_items(gmail_account.name, item_type, errors, thread_ids)
+
+
+def _queue_deferred_items(
+    gmail_account, item_type: str, item_ids: List[str], thread_ids: Dict[str, str] = None
+):
+    if not item_ids:
+        return
+    logger.info(
+        f"gmail_sync: rate limited; queued {len(item_ids)} {item_type.lower()}s for retry "
+        f"(account={gmail_account.name})"
+    )
+    defer_items(
+        gmail_account.name,
+        item_type,
+        item_ids,
+        _get_wait_seconds_if_rate_limited(gmail_account.name) or 60,
+        "Rate limited",
+        thread_ids,
+    )
+
+
 def _chunk_list(items: List[Any], chunk_size: int) -> List[List[Any]]:
     if chunk_size <= 0:
         return [items]
     return [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
 
 
-def _batch_fetch_threads(gmail, thread_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+def _chunk_by_thread(message_to_thread: Dict[str, str], chunk_size: int) -> List[List[str]]:
+    """Split message ids into chunks of about `chunk_size` that never split a thread."""
+    thread_messages: Dict[str, List[str]] = {}
+    for mid, thread_id in message_to_thread.items():
+        thread_messages.setdefault(thread_id, []).append(mid)
+    chunks = []
+    chunk = []
+    for mids in thread_messages.values():
+        if len(chunk) >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+        chunk.extend(mids)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _batch_fetch_threads(gmail, thread_ids: List[str]):
+    """Fetch threads in one batch. Returns `(threads_by_id, errors_by_id)`."""
     threads_data: Dict[str, Dict[str, Any]] = {}
     errors: Dict[str, Exception] = {}
 
@@ -169,18 +611,18 @@ def _batch_fetch_threads(gmail, thread_ids: List[str]) -> Dict[str, Dict[str, An
 
     batch = BatchHttpRequest(callback=thread_callback)
     for tid in thread_ids:
-        req = gmail.users().threads().get(userId="me", id=tid)
+        # bodies are downloaded later, and only for messages that need them
+        req = gmail.users().threads().get(
+            userId="me", id=tid, format="metadata", metadataHeaders=ROUTING_HEADERS
+        )
         batch.add(req, request_id=tid)
-    try:
-        batch.execute()
-    except googleapiclient.errors.HttpError as e:
-        # Handle top-level batch failures (e.g. 429)
-        raise e
-    # Best-effort: ignore per-item notFound errors
-    return threads_data
+    # top-level batch failures (e.g. 429) are raised to the caller
+    execute(batch)
+    return threads_data, errors
 
 
-def _batch_fetch_raw_messages(gmail, message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+def _batch_get_messages(gmail, message_ids: List[str], **params):
+    """Get messages in one batch. Returns `(messages_by_id, errors_by_id)`."""
     messages_data: Dict[str, Dict[str, Any]] = {}
     errors: Dict[str, Exception] = {}
 
@@ -192,134 +634,839 @@ def _batch_fetch_raw_messages(gmail, message_ids: List[str]) -> Dict[str, Dict[s
 
     batch = BatchHttpRequest(callback=msg_callback)
     for mid in message_ids:
-        req = gmail.users().messages().get(userId="me", id=mid, format="raw")
+        req = gmail.users().messages().get(userId="me", id=mid, **params)
         batch.add(req, request_id=mid)
-    batch.execute()
-    return messages_data
+    execute(batch)
+    return messages_data, errors
+
+
+def _batch_fetch_raw_messages(gmail, message_ids: List[str]):
+    return _batch_get_messages(gmail, message_ids, format="raw")
+
+
+def _batch_fetch_message_metadata(gmail, message_ids: List[str]):
+    return _batch_get_messages(
+        gmail, message_ids, format="metadata", metadataHeaders=ROUTING_HEADERS
+    )
+
+
+def _fetch_in_adaptive_batches(gmail_account, fetch, ids: List[str], default_size: int):
+    """Run `fetch` over `ids` in adaptive batches; returns `(results, errors, deferred_ids)`."""
+    results: Dict[str, Any] = {}
+    errors: Dict[str, Exception] = {}
+    pending = list(ids)
+    batch_size = get_batch_size(gmail_account.name, default_size)
+    rate_limited_rounds = 0
+    while pending:
+        if _get_wait_seconds_if_rate_limited(gmail_account.name) > 0:
+            # e.g. set by another fetch of the account
+            return results, errors, pending
+        chunk, pending = pending[:batch_size], pending[batch_size:]
+        chunk_results, chunk_errors = fetch(chunk)
+        results.update(chunk_results)
+        rate_limited = []
+        for item_id, error in chunk_errors.items():
+            if _is_rate_limit_error(error):
+                rate_limited.append(item_id)
+            else:
+                errors[item_id] = error
+        if not rate_limited:
+            batch_size = _update_batch_size(
+                gmail_account.name, rate_limited=False, default=default_size
+            )
+            continue
+        rate_limited_rounds += 1
+        if batch_size <= MIN_BATCH_SIZE or rate_limited_rounds >= MAX_RATE_LIMITED_ROUNDS:
+            _set_rate_limit_until(gmail_account.name, 60)
+            logger.info(
+                f"gmail_sync: {len(rate_limited)} items still rate limited; "
+                f"deferring (account={gmail_account.name})"
+            )
+            return results, errors, rate_limited + pending
+        new_size = _update_batch_size(gmail_account.name, rate_limited=True, default=default_size)
+        logger.info(
+            f"gmail_sync: {len(rate_limited)} items rate limited; batch size {batch_size} -> {new_size} "
+            f"(account={gmail_account.name})"
+        )
+        batch_size = new_size
+        pending = rate_limited + pending
+    return results, errors, []
+
+
+def _select_messages_to_download(
+    gmail_account,
+    gmail,
+    message_ids: List[str],
+    metadata: Dict[str, Dict[str, Any]] = None,
+):
+    """Drop stored, draft and shared messages from a chunk; returns `(ids, skipped)`."""
+    skipped = frappe._dict(duplicates=0, drafts=0, shared=0)
+    synced_ids = get_synced_gmail_message_ids(message_ids)
+    skipped.duplicates = len(synced_ids)
+    message_ids = [mid for mid in message_ids if mid not in synced_ids]
+    if not message_ids:
+        return [], skipped
+
+    metadata = dict(metadata or {})
+    missing_ids = [mid for mid in message_ids if mid not in metadata]
+    if missing_ids:
+        # messages whose metadata failed are downloaded anyway, drafts are
+        # filtered again once the raw message is fetched
+        metadata.update(_batch_fetch_message_metadata(gmail, missing_ids)[0])
+    to_download = []
+    rfc_message_ids: Dict[str, str] = {}
+    for mid in message_ids:
+        message = metadata.get(mid)
+        if message and "DRAFT" in message.get("labelIds", []):
+            skipped.drafts += 1
+            continue
+        rfc_message_id = normalize_message_id(
+            (get_message_header(message or {}, "Message-ID") or "").strip(" <>")
+        )
+        if rfc_message_id:
+            rfc_message_ids[mid] = rfc_message_id
+        to_download.append(mid)
+
+    shared_threads = get_threads_by_message_ids(list(rfc_message_ids.values()))
+    if not shared_threads:
+        return to_download, skipped
+
+    thread_names = set()
+    for mid, rfc_message_id in rfc_message_ids.items():
+        if rfc_message_id in shared_threads:
+            thread_names.add(shared_threads[rfc_message_id])
+            to_download.remove(mid)
+            skipped.shared += 1
+    for thread_name in thread_names:
+        add_involved_users_to_thread(thread_name, [gmail_account.linked_user])
+    return to_download, skipped
+
+
+def _get_referenced_message_ids(email_object) -> List[str]:
+    email_references = email_object.references
+    if email_references:
+        email_references = [
+            get_string_between("<", x, ">") for x in email_references.split()
+        ]
+    else:
+        email_references = []
+    return [email_object.message_id] + email_references
+
+
+def _call_in_savepoint(func, *args):
+    """Call `func` in a savepoint; returns `(result, error)`, rolled back on an error."""
+    frappe.db.savepoint(STORE_SAVEPOINT)
+    with track_written_files() as written_files:
+        try:
+            result = func(*args)
+        except Exception as e:
+            frappe.db.rollback(save_point=STORE_SAVEPOINT)
+            remove_written_files(written_files)
+            frappe.log_error(frappe.get_traceback(), "Gmail Thread Sync Error")
+            return None, e
+    frappe.db.release_savepoint(STORE_SAVEPOINT)
+    return result, None
+
+
+def _create_email(gmail_account, raw_email: Dict[str, Any], email_object=None):
+    """Build the email row of a raw message, or link the account if it is stored already."""
+    try:
+        return create_new_email(raw_email, gmail_account, email_object)
+    except AlreadyExistsError as e:
+        add_involved_users_to_thread(e.thread_name, [gmail_account.linked_user])
+
+
+def _parse_thread_emails(
+    gmail_account,
+    raw_emails: List[Dict[str, Any]],
+    email_objects: Dict[str, Any] = None,
+    seen_message_ids: set = None,
+    errors: Dict[str, Exception] = None,
+) -> List[Tuple[Any, Any]]:
+    """Build the new email rows of one thread as `(email, email_object)` pairs sorted by date."""
+    parsed = []
+    if seen_message_ids is None:
+        seen_message_ids = set()
+    if errors is None:
+        errors = {}
+    email_objects = email_objects or {}
+    for raw_email in raw_emails:
+        created, error = _call_in_savepoint(
+            _create_email,
+            gmail_account,
+            raw_email,
+            email_objects.get(raw_email.get("id")),
+        )
+        if error:
+            errors[raw_email.get("id")] = error
+            continue
+        if not created:
+            continue
+        email, email_object = created
+        if email.email_message_id in seen_message_ids:
+            discard_attachment_files(email_object)
+            continue
+        seen_message_ids.add(email.email_message_id)
+        parsed.append((email, email_object))
+    parsed.sort(key=lambda x: str(x[0].date_and_time))
+    return parsed
+
+
+def _add_emails_to_thread(
+    gmail_account,
+    thread_id: str,
+    parsed: List[Tuple[Any, Any]],
+    resolver: GmailThreadResolver,
+):
+    """Store the parsed messages of one thread; returns `(gmail_thread, stored_count)`."""
+    try:
+        gmail_thread, count = _write_emails_to_thread(
+            gmail_account, thread_id, parsed, resolver.get(thread_id)
+        )
+    finally:
+        # large attachments not saved by now were left in temporary files
+        for _email, email_object in parsed:
+            discard_attachment_files(email_object)
+    resolver.add(
+        thread_id, gmail_thread, [email.email_message_id for email, _email_object in parsed]
+    )
+    return gmail_thread, count
+
+
+def _write_emails_to_thread(
+    gmail_account, thread_id: str, parsed: List[Tuple[Any, Any]], gmail_thread=None
+):
+    """Write parsed emails to `gmail_thread`, or to a new thread if it is None."""
+    involved_users = set()
+    for _email, email_object in parsed:
+        involved_users.add(email_object.from_email)
+        involved_users.update(email_object.to)
+        involved_users.update(email_object.cc)
+        involved_users.update(email_object.bcc)
+    involved_users.add(gmail_account.linked_user)
+
+    first_email = parsed[0][0]
+    last_email = parsed[-1][0]
+    thread_values = {
+        "modified": last_email.date_and_time,
+        "owner": gmail_account.linked_user,
+        "modified_by": gmail_account.linked_user,
+    }
+
+    if gmail_thread:
+        for email, email_object in parsed:
+            process_attachments(email, gmail_thread, email_object)
+            replace_inline_images(email, email_object)
+        if not gmail_thread.subject_of_first_mail:
+            thread_values["subject_of_first_mail"] = first_email.subject
+            thread_values["creation"] = first_email.date_and_time
+            # the thread may get more messages later in the batch
+            gmail_thread.subject_of_first_mail = first_email.subject
+        append_emails_to_thread(
+            gmail_thread.name,
+            gmail_thread.owner,
+            [email for email, _email_object in parsed],
+            get_involved_user_accounts(involved_users),
+            thread_values,
+        )
+        return gmail_thread, len(parsed)
+
+    gmail_thread = frappe.new_doc("Gmail Thread")
+    gmail_thread.gmail_thread_id = thread_id
+    gmail_thread.gmail_account = gmail_account.name
+    gmail_thread.subject_of_first_mail = first_email.subject
+    update_involved_users(gmail_thread, involved_users)
+    for email, email_object in parsed:
+        process_attachments(email, gmail_thread, email_object)
+        replace_inline_images(email, email_object)
+        gmail_thread.append("emails", email)
+    gmail_thread.insert(ignore_permissions=True)
+    # insert() stamps the current time, keep the dates of the emails instead
+    thread_values["creation"] = first_email.date_and_time
+    frappe.db.set_value(
+        "Gmail Thread", gmail_thread.name, thread_values, update_modified=False
+    )
+    return gmail_thread, len(parsed)
 
 
-def _process_threads_batch(gmail_account, gmail, thread_ids: List[str]):
+def _parse_raw_messages(messages_map: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Parse the fetched messages that are not drafts, on the parse processes if configured."""
+    raw_emails = {
+        mid: raw_email
+        for mid, raw_email in messages_map.items()
+        if raw_email and "DRAFT" not in raw_email.get("labelIds", [])
+    }
+    processes = get_parse_processes()
+    if processes > 0:
+        return parse_raw_emails(raw_emails, processes)
+    email_objects = {}
+    for mid, raw_email in raw_emails.items():
+        try:
+            email_objects[mid] = parse_raw_email(raw_email)
+        except Exception:
+            # parsed again when the message is stored, which records the error
+            continue
+    return email_objects
+
+
+def _store_raw_messages(
+    gmail_account,
+    message_to_thread: Dict[str, str],
+    messages_map: Dict[str, Dict[str, Any]],
+    email_objects: Dict[str, Any] = None,
+):
+    """Store fetched messages thread by thread; returns `(threads, stored, drafts, duplicates)`."""
+    if email_objects is None and get_parse_processes() > 0:
+        email_objects = _parse_raw_messages(messages_map)
+    thread_messages: Dict[str, List[Dict[str, Any]]] = {}
+    skipped_drafts = 0
+    for mid, raw_email in messages_map.items():
+        if not raw_email or mid not in message_to_thread:
+            continue
+        if "DRAFT" in raw_email.get("labelIds", []):
+            skipped_drafts += 1
+            continue
+        thread_messages.setdefault(message_to_thread[mid], []).append(raw_email)
+
+    updated_threads = []
+    stored = 0
+    duplicates = 0
+    parsed_threads = {}
+    errors: Dict[str, Exception] = {}
+    # a Message-ID is stored once, even if it shows up in two threads of the batch
+    seen_message_ids = set()
+    try:
+        for thread_id, raw_emails in thread_messages.items():
+            failed = len(errors)
+            parsed = _parse_thread_emails(
+                gmail_account, raw_emails, email_objects, seen_message_ids, errors
+            )
+            duplicates += len(raw_emails) - len(parsed) - (len(errors) - failed)
+            if parsed:
+                parsed_threads[thread_id] = parsed
+
+        # the threads of the whole batch are looked up at once
+        resolver = GmailThreadResolver(
+            {
+                thread_id: [
+                    message_id
+                    for _email, email_object in parsed
+                    for message_id in _get_referenced_message_ids(email_object)
+                ]
+                for thread_id, parsed in parsed_threads.items()
+            }
+        )
+        for thread_id, parsed in parsed_threads.items():
+            added, error = _call_in_savepoint(
+                _add_emails_to_thread, gmail_account, thread_id, parsed, resolver
+            )
+            if error:
+                for email, _email_object in parsed:
+                    errors[email.gmail_message_id] = error
+                continue
+            gmail_thread, count = added
+            stored += count
+            updated_threads.append(gmail_thread)
+        _queue_fetch_errors(gmail_account, "Message", errors, message_to_thread)
+    finally:
+        for parsed in parsed_threads.values():
+            for _email, email_object in parsed:
+                discard_attachment_files(email_object)
+        for email_object in (email_objects or {}).values():
+            discard_attachment_files(email_object)
+    frappe.db.commit()  # nosemgrep
+    return updated_threads, stored, skipped_drafts, duplicates
+
+
+def _process_threads_batch(
+    gmail_account, gmail, thread_ids: List[str], batch_size: int = DEFAULT_BATCH_SIZE
+) -> bool:
+    """Fetch and store the messages of the given threads; returns False if rate limited."""
     # Check if we should delay due to rate limit
     wait_s = _get_wait_seconds_if_rate_limited(gmail_account.name)
     if wait_s > 0:
         # Skip processing now; cron will pick it up later
-        return
+        return False
 
     try:
-        threads_map = _batch_fetch_threads(gmail, thread_ids)
+        fetched = _fetch_in_adaptive_batches(
+            gmail_account,
+            lambda ids: _batch_fetch_threads(gmail, ids),
+            thread_ids,
+            batch_size,
+        )
     except googleapiclient.errors.HttpError as e:
-        status = getattr(getattr(e, "resp", None), "status", None)
-        if status == 429:
-            retry_after = getattr(e, "resp", {}).get("retry-after") if hasattr(e, "resp") else None
-            retry_after_seconds = int(retry_after) if retry_after and str(retry_after).isdigit() else 60
-            _set_rate_limit_until(gmail_account.name, retry_after_seconds)
-            return
+        if _defer_if_rate_limited(gmail_account.name, e):
+            return False
         raise
+    threads_map, errors, deferred = fetched
+    _queue_fetch_errors(gmail_account, "Thread", errors)
+    _queue_deferred_items(gmail_account, "Thread", deferred)
 
-    # Collect all message ids from all threads in this batch
-    message_ids: List[str] = []
-    thread_id_to_message_ids: Dict[str, List[str]] = {}
+    # Collect all message ids from all threads in this batch, thread by thread
+    message_to_thread: Dict[str, str] = {}
+    message_metadata: Dict[str, Dict[str, Any]] = {}
     for tid, thread_data in threads_map.items():
-        mids = [m.get("id") for m in thread_data.get("messages", []) if m.get("id")]
-        if mids:
-            thread_id_to_message_ids[tid] = mids
-            message_ids.extend(mids)
+        for message in thread_data.get("messages", []):
+            if message.get("id"):
+                message_to_thread[message["id"]] = tid
+                message_metadata[message["id"]] = message
 
-    # Fetch all messages in batch (may be large; split into sub-batches of 50)
-    for mids_chunk in _chunk_list(message_ids, 50):
+    pipeline_workers = _get_sync_settings().pipeline_workers
+    if pipeline_workers > 0:
+        return _store_threads_pipelined(
+            gmail_account,
+            gmail,
+            message_to_thread,
+            message_metadata,
+            batch_size,
+            pipeline_workers,
+        )
+
+    # Fetch all messages in batch (may be large; split into sub-batches)
+    for mids_chunk in _chunk_by_thread(
+        message_to_thread, get_batch_size(gmail_account.name, batch_size)
+    ):
         try:
-            messages_map = _batch_fetch_raw_messages(gmail, mids_chunk)
+            mids_chunk, _skipped = _select_messages_to_download(
+                gmail_account,
+                gmail,
+                mids_chunk,
+                {mid: message_metadata[mid] for mid in mids_chunk},
+            )
+            if not mids_chunk:
+                continue
+            fetched = _fetch_in_adaptive_batches(
+                gmail_account,
+                lambda ids: _batch_fetch_raw_messages(gmail, ids),
+                mids_chunk,
+                batch_size,
+            )
         except googleapiclient.errors.HttpError as e:
-            status = getattr(getattr(e, "resp", None), "status", None)
-            if status == 429:
-                retry_after = getattr(e, "resp", {}).get("retry-after") if hasattr(e, "resp") else None
-                retry_after_seconds = int(retry_after) if retry_after and str(retry_after).isdigit() else 60
-                _set_rate_limit_until(gmail_account.name, retry_after_seconds)
-                return
+            if _defer_if_rate_limited(gmail_account.name, e):
+                return False
             raise
+        messages_map, errors, deferred = fetched
+        _queue_fetch_errors(gmail_account, "Message", errors, message_to_thread)
+        _queue_deferred_items(gmail_account, "Message", deferred, message_to_thread)
+        _store_raw_messages(gmail_account, message_to_thread, messages_map)
+    return True
 
-        # Process messages, building/augmenting threads
-        processed_threads: Dict[str, Dict[str, Any]] = {}
-        for tid, mids in thread_id_to_message_ids.items():
-            for mid in mids:
-                raw_email = messages_map.get(mid)
-                if not raw_email:
-                    continue
-                if "DRAFT" in raw_email.get("labelIds", []):
-                    continue
-                gmail_thread = find_gmail_thread(tid)
-                involved_users = set()
-                is_new_thread = False
-                try:
-                    email, email_object = create_new_email(raw_email, gmail_account)
-                except AlreadyExistsError:
-                    continue
-                if not gmail_thread:
-                    email_message_id = email_object.message_id
-                    email_references = email_object.mail.get("References")
-                    if email_references:
-                        email_references = [
-                            get_string_between("<", x, ">") for x in email_references.split()
-                        ]
-                    else:
-                        email_references = []
-                    gmail_thread = find_gmail_thread(tid, [email_message_id] + email_references)
-                if gmail_thread:
-                    gmail_thread.reload()
-                else:
-                    gmail_thread = frappe.new_doc("Gmail Thread")
-                    gmail_thread.gmail_thread_id = tid
-                    gmail_thread.gmail_account = gmail_account.name
-                    is_new_thread = True
-                if not gmail_thread.subject_of_first_mail:
-                    gmail_thread.subject_of_first_mail = email.subject
-                    gmail_thread.creation = email.date_and_time
-                involved_users.add(email_object.from_email)
-                for recipient in email_object.to:
-                    involved_users.add(recipient)
-                for recipient in email_object.cc:
-                    involved_users.add(recipient)
-                for recipient in email_object.bcc:
-                    involved_users.add(recipient)
-                involved_users.add(gmail_account.linked_user)
-                update_involved_users(gmail_thread, involved_users)
-                process_attachments(email, gmail_thread, email_object)
-                replace_inline_images(email, email_object)
-                gmail_thread.append("emails", email)
-                gmail_thread.save(ignore_permissions=True)
-                frappe.db.commit()  # nosemgrep
-                frappe.db.set_value(
-                    "Gmail Thread",
-                    gmail_thread.name,
-                    "modified",
-                    email.date_and_time,
-                    update_modified=False,
-                )
-                if is_new_thread:  # update creation date
-                    frappe.db.set_value(
-                        "Gmail Thread",
-                        gmail_thread.name,
-                        "creation",
-                        email.date_and_time,
-                        update_modified=False,
-                    )
-                frappe.db.set_value(
-                    "Gmail Thread",
-                    gmail_thread.name,
-                    "owner",
-                    gmail_account.linked_user,
-                    modified_by=gmail_account.linked_user,
-                    update_modified=False,
-                )
+
+def _store_threads_pipelined(
+    gmail_account,
+    gmail,
+    message_to_thread: Dict[str, str],
+    message_metadata: Dict[str, Dict[str, Any]],
+    batch_size: int,
+    workers: int,
+) -> bool:
+    """Like _process_threads_batch, with fetching, parsing and storing overlapped."""
+    chunks = []
+    for mids_chunk in _chunk_by_thread(
+        message_to_thread, get_batch_size(gmail_account.name, batch_size)
+    ):
+        mids_chunk, _skipped = _select_messages_to_download(
+            gmail_account,
+            gmail,
+            mids_chunk,
+            {mid: message_metadata[mid] for mid in mids_chunk},
+        )
+        if mids_chunk:
+            chunks.append(mids_chunk)
+    if not chunks:
+        return True
+
+    def fetch(mids_chunk):
+        # built (and cached) per thread, httplib2 is not thread-safe
+        thread_gmail = get_gmail_object(gmail_account)
+        return _fetch_in_adaptive_batches(
+            gmail_account,
+            lambda ids: _batch_fetch_raw_messages(thread_gmail, ids),
+            mids_chunk,
+            batch_size,
+        )
+
+    def parse(fetched):
+        messages_map, errors, deferred = fetched
+        return messages_map, errors, deferred, _parse_raw_messages(messages_map)
+
+    def write(parsed):
+        messages_map, errors, deferred, email_objects = parsed
+        _queue_fetch_errors(gmail_account, "Message", errors, message_to_thread)
+        _queue_deferred_items(gmail_account, "Message", deferred, message_to_thread)
+        _store_raw_messages(gmail_account, message_to_thread, messages_map, email_objects)
+
+    def discard(parsed):
+        # parsed but never written, e.g. after a failed write
+        for email_object in parsed[3].values():
+            discard_attachment_files(email_object)
+
+    try:
+        return run_pipeline(chunks, fetch, parse, write, workers, discard=discard)
+    except googleapiclient.errors.HttpError as e:
+        if _defer_if_rate_limited(gmail_account.name, e):
+            return False
+        raise
 
 
 @frappe.whitelist()  # nosemgrep
 def process_thread_batch(user: str, label_id: str, thread_ids: List[str]):
+    """Background job storing a chunk of threads of a label's initial sync."""
     if user:
         frappe.set_user(user)
     gmail_account = frappe.get_doc("Gmail Account", {"linked_user": user})
-    gmail = get_gmail_object(gmail_account)
-    _process_threads_batch(gmail_account, gmail, thread_ids)
+    try:
+        gmail = get_gmail_object(gmail_account)
+        with parse_pool_scope():
+            stored = _process_threads_batch(
+                gmail_account, gmail, thread_ids, _get_sync_settings().batch_size
+            )
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "Gmail Thread Sync Error")
+        queue_failed_items(gmail_account.name, "Thread", dict.fromkeys(thread_ids, e))
+    else:
+        if stored:
+            remove_batch_items(gmail_account.name, thread_ids)
+        else:
+            # rate limited before anything was fetched
+            _queue_deferred_items(gmail_account, "Thread", thread_ids)
+    frappe.db.commit()  # nosemgrep
+
+
+def _iter_label_thread_pages(gmail, label_id: str, page_token: str = None):
+    """Yield `(thread_ids, next_page_token)` for each page of threads in a label."""
+    while True:
+        params = {"userId": "me", "labelIds": label_id, "maxResults": THREADS_PAGE_SIZE}
+        if page_token:
+            params["pageToken"] = page_token
+        response = execute(gmail.users().threads().list(**params))
+        thread_ids = [t["id"] for t in response.get("threads", [])]
+        page_token = response.get("nextPageToken")
+        yield thread_ids, page_token
+        if not page_token:
+            return
+
+
+def _set_label_sync_cursor(label, **values):
+    label.update(values)
+    frappe.db.set_value("Gmail Label", label.name, values, update_modified=False)
+    frappe.db.commit()  # nosemgrep
+
+
+def _store_initial_sync_chunk(
+    gmail_account, gmail, thread_ids: List[str], batch_size: int
+) -> bool:
+    """Store a chunk of threads of the initial sync; returns False if rate limited."""
+    try:
+        return _process_threads_batch(gmail_account, gmail, thread_ids, batch_size)
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "Gmail Thread Sync Error")
+        _queue_fetch_errors(gmail_account, "Thread", dict.fromkeys(thread_ids, e))
+        return True
+
+
+def _initial_sync_label(
+    gmail_account,
+    gmail,
+    label,
+    batch_size: int,
+    batch_jobs: bool,
+    max_threads: int,
+) -> bool:
+    """Sync a label page by page from its saved cursor; returns True once it is done."""
+    user = gmail_account.linked_user
+    last_thread_id = label.sync_last_thread_id
+    threads_done = label.sync_threads_done or 0
+
+    for thread_ids, next_page_token in _iter_label_thread_pages(
+        gmail, label.label_id, label.sync_page_token
+    ):
+        # process the oldest threads of the page first
+        thread_ids.reverse()
+        if last_thread_id in thread_ids:
+            # resuming a page that was partially processed
+            thread_ids = thread_ids[thread_ids.index(last_thread_id) + 1 :]
+        last_thread_id = None
+        if max_threads > 0:
+            thread_ids = thread_ids[: max(0, max_threads - threads_done)]
+
+        for chunk in _chunk_list(thread_ids, batch_size):
+            if batch_jobs:
+                queue_batch_items(gmail_account.name, chunk)
+                job_name = f"gmail_thread_batch_{user}_{label.label_id}_{chunk[0]}"
+                frappe.enqueue(
+                    "frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_thread.gmail_thread.process_thread_batch",
+                    user=user,
+                    label_id=label.label_id,
+                    thread_ids=chunk,
+                    queue="long",
+                    timeout=BATCH_JOB_TIMEOUT,
+                    job_name=job_name,
+                    job_id=job_name,
+                    enqueue_after_commit=True,
+                )
+            elif not _store_initial_sync_chunk(gmail_account, gmail, chunk, batch_size):
+                # rate limited; resume from this chunk on the next run
+                return False
+            threads_done += len(chunk)
+            _set_label_sync_cursor(
+                label, sync_last_thread_id=chunk[-1], sync_threads_done=threads_done
+            )
+
+        if max_threads > 0 and threads_done >= max_threads:
+            break
+        _set_label_sync_cursor(
+            label, sync_page_token=next_page_token, sync_last_thread_id=None
+        )
+
+    _set_label_sync_cursor(
+        label,
+        initial_sync_completed=1,
+        sync_page_token=None,
+        sync_last_thread_id=None,
+    )
+    return True
+
+
+def _initial_sync(
+    gmail_account, gmail, batch_size: int, batch_jobs: bool, max_threads: int
+):
+    """Run or resume the initial sync of all enabled labels."""
+    if not gmail_account.initial_sync_historyid:
+        profile = execute(gmail.users().getProfile(userId="me"))
+        gmail_account.initial_sync_historyid = int(profile["historyId"])
+        frappe.db.set_value(
+            "Gmail Account",
+            gmail_account.name,
+            "initial_sync_historyid",
+            gmail_account.initial_sync_historyid,
+            update_modified=False,
+        )
+        frappe.db.commit()  # nosemgrep
+
+    completed = True
+    for label in gmail_account.labels:
+        if not label.enabled or label.initial_sync_completed:
+            continue
+        try:
+            if not _initial_sync_label(
+                gmail_account, gmail, label, batch_size, batch_jobs, max_threads
+            ):
+                completed = False
+                break
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), "Gmail Thread Sync Error")
+            completed = False
+
+    if not completed:
+        return
+    if has_batch_items(gmail_account.name):
+        logger.info(
+            f"gmail_sync: waiting for batch jobs to store their threads (account={gmail_account.name})"
+        )
+        return
+
+    history_id = gmail_account.initial_sync_historyid
+    gmail_account.reload()
+    gmail_account.last_historyid = history_id
+    gmail_account.reset_initial_sync_state()
+    gmail_account.save(ignore_permissions=True)
+    frappe.db.commit()  # nosemgrep
+
+
+def _iter_history_pages(gmail, start_history_id: int):
+    """Yield `(records, checkpoint_history_id)` per page of history after `start_history_id`."""
+    page_token = None
+    while True:
+        params = {
+            "userId": "me",
+            "startHistoryId": start_history_id,
+            "historyTypes": ["messageAdded", "labelAdded"],
+            "maxResults": HISTORY_PAGE_SIZE,
+        }
+        if page_token:
+            params["pageToken"] = page_token
+        response = execute(gmail.users().history().list(**params))
+        records = response.get("history", [])
+        page_token = response.get("nextPageToken")
+        # records come in ascending order and the last page carries the
+        # current history id, so a page's checkpoint is safe once it is stored
+        if page_token:
+            checkpoint = int(records[-1]["id"]) if records else start_history_id
+        else:
+            checkpoint = int(response.get("historyId", start_history_id))
+        yield records, checkpoint
+        if not page_token:
+            return
+
+
+def _get_history_messages(
+    records: List[Dict[str, Any]], label_ids: List[str]
+) -> Dict[str, Dict[str, Any]]:
+    """Map message ids to the messages of the history records touching `label_ids`."""
+    label_ids = set(label_ids)
+    messages: Dict[str, Dict[str, Any]] = {}
+    for hist in records:
+        changes = [
+            (added.get("message", {}), added.get("message", {}).get("labelIds", []))
+            for added in hist.get("messagesAdded", [])
+        ] + [
+            (added.get("message", {}), added.get("labelIds", []))
+            for added in hist.get("labelsAdded", [])
+        ]
+        for message, message_label_ids in changes:
+            mid = message.get("id")
+            tid = message.get("threadId")
+            if not mid or not tid or not label_ids.intersection(message_label_ids):
+                continue
+            messages[mid] = message
+    return messages
+
+
+def _store_messages(
+    gmail_account,
+    gmail,
+    message_to_thread: Dict[str, str],
+    batch_size: int,
+    metadata: Dict[str, Dict[str, Any]] = None,
+):
+    """Fetch and store messages by whole threads; returns `(completed, processed, threads)`."""
+    total_processed = 0
+    total_skipped_draft = 0
+    total_duplicates = 0
+    total_shared = 0
+    updated_threads = []
+    for mids_chunk in _chunk_by_thread(
+        message_to_thread, get_batch_size(gmail_account.name, batch_size)
+    ):
+        # Rate-limit gate
+        wait_s = _get_wait_seconds_if_rate_limited(gmail_account.name)
+        if wait_s > 0:
+            logger.info(
+                f"gmail_sync: rate-limited; deferring chunk (account={gmail_account.name}, wait_s={wait_s})"
+            )
+            return False, total_processed, updated_threads
+        try:
+            mids_chunk, skipped = _select_messages_to_download(
+                gmail_account,
+                gmail,
+                mids_chunk,
+                metadata
+                and {mid: metadata[mid] for mid in mids_chunk if mid in metadata},
+            )
+            total_duplicates += skipped.duplicates
+            total_skipped_draft += skipped.drafts
+            total_shared += skipped.shared
+            if not mids_chunk:
+                continue
+            fetched = _fetch_in_adaptive_batches(
+                gmail_account,
+                lambda ids: _batch_fetch_raw_messages(gmail, ids),
+                mids_chunk,
+                batch_size,
+            )
+        except googleapiclient.errors.HttpError as e:
+            if _defer_if_rate_limited(gmail_account.name, e):
+                return False, total_processed, updated_threads
+            raise
+        messages_map, errors, deferred = fetched
+        _queue_fetch_errors(gmail_account, "Message", errors, message_to_thread)
+
+        threads, stored, skipped_drafts, duplicates = _store_raw_messages(
+            gmail_account, message_to_thread, messages_map
+        )
+        updated_threads.extend(threads)
+        total_processed += stored
+        total_skipped_draft += skipped_drafts
+        total_duplicates += duplicates
+        if deferred:
+            # replayed once the window has passed; stored messages are skipped then
+            return False, total_processed, updated_threads
+
+    logger.info(
+        f"gmail_sync: stored account={gmail_account.name} processed={total_processed} "
+        f"drafts_skipped={total_skipped_draft} duplicates={total_duplicates} shared={total_shared} "
+        f"batch_size={get_batch_size(gmail_account.name, batch_size)}"
+    )
+    return True, total_processed, updated_threads
+
+
+def _retry_items(
+    gmail_account, gmail, thread_ids: List[str], message_to_thread: Dict[str, str], batch_size: int
+) -> bool:
+    if thread_ids and not _process_threads_batch(gmail_account, gmail, thread_ids, batch_size):
+        return False
+    if message_to_thread:
+        completed, _processed, _threads = _store_messages(
+            gmail_account, gmail, message_to_thread, batch_size
+        )
+        return completed
+    return True
+
+
+def _retry_items_one_by_one(gmail_account, gmail, items: List[Dict], batch_size: int) -> bool:
+    """Retry `items` one at a time after their batch failed as a whole."""
+    for item in items:
+        thread_ids = [item.item_id] if item.item_type == "Thread" else []
+        message_to_thread = {item.item_id: item.thread_id} if item.item_type == "Message" else {}
+        try:
+            if not _retry_items(gmail_account, gmail, thread_ids, message_to_thread, batch_size):
+                return False
+        except Exception as e:
+            frappe.db.rollback()
+            logger.warning(
+                f"gmail_sync: retry failed (account={gmail_account.name}, "
+                f"{item.item_type.lower()}={item.item_id}): {e}"
+            )
+            queue_failed_items(
+                gmail_account.name, item.item_type, {item.item_id: e}, message_to_thread
+            )
+            frappe.db.commit()  # nosemgrep
+    return True
+
+
+def _retry_failed_items(gmail_account, gmail, batch_size: int) -> bool:
+    """Retry the queued threads and messages that are due; returns False if rate limited."""
+    items = get_due_items(gmail_account.name)
+    if not items:
+        return True
+    started_at = now_datetime()
+    thread_ids = [item.item_id for item in items if item.item_type == "Thread"]
+    message_to_thread = {
+        item.item_id: item.thread_id for item in items if item.item_type == "Message"
+    }
+    try:
+        completed = _retry_items(
+            gmail_account, gmail, thread_ids, message_to_thread, batch_size
+        )
+    except Exception:
+        frappe.db.rollback()
+        completed = _retry_items_one_by_one(gmail_account, gmail, items, batch_size)
+    if not completed:
+        return False
+    remove_retried_items(items, started_at)
+    frappe.db.commit()  # nosemgrep
+    logger.info(
+        f"gmail_sync: retried account={gmail_account.name} threads={len(thread_ids)} "
+        f"messages={len(message_to_thread)}"
+    )
+    return True
+
+
+def _checkpoint_history_id(gmail_account, history_id: int, current_history_id: int) -> int:
+    """Persist `history_id` as the account's sync cursor if it moves it forward."""
+    if history_id <= current_history_id:
+        return current_history_id
+    frappe.db.commit()  # nosemgrep: messages of the page must be durable first
+    gmail_account.reload()
+    gmail_account.last_historyid = history_id
+    gmail_account.save(ignore_permissions=True)
+    frappe.db.commit()  # nosemgrep
+    return history_id
 
 
 def sync(user=None):
@@ -336,359 +1483,113 @@ def sync(user=None):
     gmail = get_gmail_object(gmail_account)
     label_ids = [x.label_id for x in gmail_account.labels if x.enabled]
     if not label_ids:
-        return
+        return 0
+
+    # one sync per account at a time, so history checkpoints stay in order
+    with _hold_sync_lock(gmail_account.name) as locked:
+        if not locked:
+            logger.info(f"gmail_sync: already running; skipping (account={gmail_account.name})")
+            return 0
+        with parse_pool_scope():
+            return _sync_account(gmail_account, gmail, label_ids)
 
+
+def _sync_account(gmail_account, gmail, label_ids: List[str]) -> int:
+    """Run the initial or incremental sync of an account."""
     # Always store the maximum history id seen, to avoid skipping emails
     last_history_id = int(gmail_account.last_historyid or 0)
     max_history_id = last_history_id
 
-    google_settings = _get_google_settings()
-    max_threads_per_label = 0
-    batch_size = 0
-    batch_jobs = False
-    if google_settings:
-        try:
-            max_threads_per_label = int(getattr(google_settings, "custom_gmail_max_threads_per_label", 0) or 0)
-        except Exception:
-            max_threads_per_label = 0
-        try:
-            batch_size = int(getattr(google_settings, "custom_gmail_batch_size", 0) or 0)
-        except Exception:
-            batch_size = 0
-        batch_jobs = bool(getattr(google_settings, "custom_gmail_batch_jobs", 0))
+    settings = _get_sync_settings()
+    # items that failed on earlier runs go first
+    if not _retry_failed_items(gmail_account, gmail, settings.batch_size):
+        return 0
 
-    for label_id in label_ids:
-        try:
-            if not last_history_id:
-                # Initial sync: fetch all threads for the label
-                threads = (
-                    gmail.users()
-                    .threads()
-                    .list(userId="me", labelIds=label_id)
-                    .execute()
+    if not last_history_id:
+        _initial_sync(
+            gmail_account,
+            gmail,
+            settings.batch_size,
+            settings.batch_jobs,
+            settings.max_threads_per_label,
+        )
+        return 0
+
+    # Incremental sync using history API: one pass over the mailbox history,
+    # filtered locally by the enabled labels
+    start_time = time.time()
+    seen_message_ids = set()
+    updated_docs = set()
+    total_processed = 0
+    try:
+        for records, page_history_id in _iter_history_pages(gmail, last_history_id):
+            # the labelIds of the history records are enough to skip drafts,
+            # so no metadata is fetched; messages another account stored are
+            # linked when they are stored (see _create_email)
+            messages = {
+                mid: message
+                for mid, message in _get_history_messages(records, label_ids).items()
+                if mid not in seen_message_ids
+            }
+            message_to_thread = {mid: message["threadId"] for mid, message in messages.items()}
+            if message_to_thread:
+                completed, processed, threads = _store_messages(
+                    gmail_account, gmail, message_to_thread, settings.batch_size, messages
                 )
-                if "threads" not in threads:
-                    continue
-                # Apply limit if configured
-                thread_list = threads["threads"][::-1]
-                if max_threads_per_label > 0:
-                    thread_list = thread_list[:max_threads_per_label]
-
-                # If batching is enabled, process in chunks, possibly enqueuing as separate jobs
-                if batch_size and batch_size > 0:
-                    thread_id_chunks = _chunk_list([t["id"] for t in thread_list], batch_size)
-                    for chunk in thread_id_chunks:
-                        if batch_jobs:
-                            job_name = f"gmail_thread_batch_{user}_{label_id}_{chunk[0]}"
-                            frappe.enqueue(
-                                "frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_thread.gmail_thread.process_thread_batch",
-                                user=user,
-                                label_id=label_id,
-                                thread_ids=chunk,
-                                queue="long",
-                                job_name=job_name,
-                                job_id=job_name,
-                            )
-                        else:
-                            _process_threads_batch(gmail_account, gmail, chunk)
-                    # Continue to next label after enqueuing/processing batches
-                    gmail_account.reload()
-                    gmail_account.last_historyid = max_history_id
-                    gmail_account.save(ignore_permissions=True)
-                    frappe.db.commit()  # nosemgrep
-                    continue
-
-                for thread in thread_list:
-                    thread_id = thread["id"]
-                    thread_data = (
-                        gmail.users().threads().get(userId="me", id=thread_id).execute()
-                    )
-                    gmail_thread = find_gmail_thread(thread_id)
-                    involved_users = set()
-                    email = None
-                    for message in thread_data["messages"]:
-                        # Track max history id
-                        msg_history_id = int(message.get("historyId", 0))
-                        if msg_history_id > max_history_id:
-                            max_history_id = msg_history_id
-                        try:
-                            raw_email = (
-                                gmail.users()
-                                .messages()
-                                .get(userId="me", id=message["id"], format="raw")
-                                .execute()
-                            )
-                        except googleapiclient.errors.HttpError as e:
-                            if hasattr(e, "error_details"):
-                                for error in e.error_details:
-                                    if error.get("reason") == "notFound":
-                                        break
-                            else:
-                                raise e
-                            continue
-                        if "DRAFT" in raw_email.get("labelIds", []):
-                            continue
-                        is_new_thread = False
-                        try:
-                            email, email_object = create_new_email(
-                                raw_email, gmail_account
-                            )
-                        except AlreadyExistsError:
-                            continue
-                        if not gmail_thread:
-                            email_message_id = email_object.message_id
-                            email_references = email_object.mail.get("References")
-                            if email_references:
-                                email_references = [
-                                    get_string_between("<", x, ">")
-                                    for x in email_references.split()
-                                ]
-                            else:
-                                email_references = []
-                            gmail_thread = find_gmail_thread(
-                                thread_id, [email_message_id] + email_references
-                            )
-                        if gmail_thread:
-                            gmail_thread.reload()
-                        else:
-                            gmail_thread = frappe.new_doc("Gmail Thread")
-                            gmail_thread.gmail_thread_id = thread_id
-                            gmail_thread.gmail_account = gmail_account.name
-                            is_new_thread = True
-                        if not gmail_thread.subject_of_first_mail:
-                            gmail_thread.subject_of_first_mail = email.subject
-                            gmail_thread.creation = email.date_and_time
-                        involved_users.add(email_object.from_email)
-                        for recipient in email_object.to:
-                            involved_users.add(recipient)
-                        for recipient in email_object.cc:
-                            involved_users.add(recipient)
-                        for recipient in email_object.bcc:
-                            involved_users.add(recipient)
-                        involved_users.add(gmail_account.linked_user)
-                        update_involved_users(gmail_thread, involved_users)
-                        process_attachments(email, gmail_thread, email_object)
-                        replace_inline_images(email, email_object)
-                        gmail_thread.append("emails", email)
-                        gmail_thread.save(ignore_permissions=True)
-                        frappe.db.commit()  # nosemgrep
-                        frappe.db.set_value(
-                            "Gmail Thread",
-                            gmail_thread.name,
-                            "modified",
-                            email.date_and_time,
-                            update_modified=False,
-                        )
-                        if is_new_thread:  # update creation date
-                            frappe.db.set_value(
-                                "Gmail Thread",
-                                gmail_thread.name,
-                                "creation",
-                                email.date_and_time,
-                                update_modified=False,
-                            )
-                        frappe.db.set_value(
-                            "Gmail Thread",
-                            gmail_thread.name,
-                            "owner",
-                            gmail_account.linked_user,
-                            modified_by=gmail_account.linked_user,
-                            update_modified=False,
-                        )
-                gmail_account.reload()
-                gmail_account.last_historyid = max_history_id
-                gmail_account.save(ignore_permissions=True)
-                frappe.db.commit()  # nosemgrep
-            else:
-                # Incremental sync using history API
-                try:
-                    history = (
-                        gmail.users()
-                        .history()
-                        .list(
-                            userId="me",
-                            startHistoryId=last_history_id,
-                            historyTypes=["messageAdded", "labelAdded"],
-                            labelId=label_id,
+                total_processed += processed
+                for gmail_thread in threads:
+                    if gmail_thread.reference_doctype and gmail_thread.reference_name:
+                        updated_docs.add(
+                            (gmail_thread.reference_doctype, gmail_thread.reference_name)
                         )
-                        .execute()
-                    )
-                except googleapiclient.errors.HttpError as e:
-                    # If notFound, update historyid to the value returned by API (if any)
-                    # You won't find history id in error, so just reset to 0 and let next sync do initial sync
-                    if hasattr(e, "error_details"):
-                        for error in e.error_details:
-                            if error.get("reason") == "notFound":
-                                gmail_account.last_historyid = 0
-                                gmail_account.save(ignore_permissions=True)
-                                frappe.db.commit()
-                                return
-                    raise e
-
-                new_history_id = int(history.get("historyId", last_history_id))
-                if new_history_id > max_history_id:
-                    max_history_id = new_history_id
-                updated_docs = set()
-                if "history" in history:
-                    # Collect message ids and thread mapping
-                    message_ids: List[str] = []
-                    message_to_thread: Dict[str, str] = {}
-                    for hist in history["history"]:
-                        for message in hist.get("messages", []):
-                            mid = message.get("id")
-                            tid = message.get("threadId")
-                            if not mid or not tid:
-                                continue
-                            message_ids.append(mid)
-                            message_to_thread[mid] = tid
-
-                    if not message_ids:
-                        gmail_account.reload()
-                        gmail_account.last_historyid = max_history_id
-                        gmail_account.save(ignore_permissions=True)
-                        frappe.db.commit()  # nosemgrep
-                        continue
-
-                    start_time = time.time()
-                    total_processed = 0
-                    total_skipped_draft = 0
-                    total_duplicates = 0
-
-                    # Use batch_size if configured; fall back to 50
-                    incremental_batch_size = batch_size if batch_size and batch_size > 0 else 50
-
-                    for mids_chunk in _chunk_list(message_ids, incremental_batch_size):
-                        # Rate-limit gate
-                        wait_s = _get_wait_seconds_if_rate_limited(gmail_account.name)
-                        if wait_s > 0:
-                            logger.info(
-                                f"gmail_sync: rate-limited; deferring chunk (account={gmail_account.name}, wait_s={wait_s})"
-                            )
-                            break
-                        try:
-                            messages_map = _batch_fetch_raw_messages(gmail, mids_chunk)
-                        except googleapiclient.errors.HttpError as e:
-                            status = getattr(getattr(e, "resp", None), "status", None)
-                            if status == 429:
-                                retry_after = getattr(e, "resp", {}).get("retry-after") if hasattr(e, "resp") else None
-                                retry_after_seconds = int(retry_after) if retry_after and str(retry_after).isdigit() else 60
-                                _set_rate_limit_until(gmail_account.name, retry_after_seconds)
-                                logger.info(
-                                    f"gmail_sync: 429 received; setting retry-after {retry_after_seconds}s (account={gmail_account.name})"
-                                )
-                                break
-                            raise
-
-                        for mid, raw_email in messages_map.items():
-                            if not raw_email:
-                                continue
-                            if "DRAFT" in raw_email.get("labelIds", []):
-                                total_skipped_draft += 1
-                                continue
-                            thread_id = message_to_thread.get(mid)
-                            if not thread_id:
-                                continue
-                            gmail_thread = find_gmail_thread(thread_id)
-                            involved_users = set()
-                            is_new_thread = False
-                            try:
-                                email, email_object = create_new_email(raw_email, gmail_account)
-                            except AlreadyExistsError:
-                                total_duplicates += 1
-                                continue
-                            if not gmail_thread:
-                                email_message_id = email_object.message_id
-                                email_references = email_object.mail.get("References")
-                                if email_references:
-                                    email_references = [
-                                        get_string_between("<", x, ">")
-                                        for x in email_references.split()
-                                    ]
-                                else:
-                                    email_references = []
-                                gmail_thread = find_gmail_thread(
-                                    thread_id, [email_message_id] + email_references
-                                )
-                            if not gmail_thread:
-                                gmail_thread = frappe.new_doc("Gmail Thread")
-                                gmail_thread.gmail_thread_id = thread_id
-                                gmail_thread.gmail_account = gmail_account.name
-                                is_new_thread = True
-                            if not gmail_thread.subject_of_first_mail:
-                                gmail_thread.subject_of_first_mail = email.subject
-                                gmail_thread.creation = email.date_and_time
-                            involved_users.add(email_object.from_email)
-                            for recipient in email_object.to:
-                                involved_users.add(recipient)
-                            for recipient in email_object.cc:
-                                involved_users.add(recipient)
-                            for recipient in email_object.bcc:
-                                involved_users.add(recipient)
-                            involved_users.add(gmail_account.linked_user)
-                            update_involved_users(gmail_thread, involved_users)
-                            process_attachments(email, gmail_thread, email_object)
-                            replace_inline_images(email, email_object)
-                            gmail_thread.append("emails", email)
-                            gmail_thread.save(ignore_permissions=True)
-                            frappe.db.set_value(
-                                "Gmail Thread",
-                                gmail_thread.name,
-                                "modified",
-                                email.date_and_time,
-                                update_modified=False,
-                            )
-                            if is_new_thread:  # update creation date
-                                frappe.db.set_value(
-                                    "Gmail Thread",
-                                    gmail_thread.name,
-                                    "creation",
-                                    email.date_and_time,
-                                    update_modified=False,
-                                )
-                            if (
-                                gmail_thread.reference_doctype
-                                and gmail_thread.reference_name
-                            ):
-                                updated_docs.add(
-                                    (
-                                        gmail_thread.reference_doctype,
-                                        gmail_thread.reference_name,
-                                    )
-                                )
-                            total_processed += 1
-
-                    elapsed = round((time.time() - start_time), 2)
-                    logger.info(
-                        f"gmail_sync: incremental label={label_id} processed={total_processed} drafts_skipped={total_skipped_draft} duplicates={total_duplicates} elapsed_s={elapsed}"
-                    )
-                gmail_account.reload()
-                gmail_account.last_historyid = max_history_id
-                gmail_account.save(ignore_permissions=True)
-                frappe.db.commit()  # nosemgrep
-                if updated_docs:
-                    for doctype, docname in updated_docs:
-                        frappe.publish_realtime(
-                            "gthread_new_email",
-                            doctype=doctype,
-                            docname=docname,
-                        )
-        except Exception:
-            frappe.log_error(frappe.get_traceback(), "Gmail Thread Sync Error")
-            continue
+                if not completed:
+                    # rate limited; replay this page on the next run
+                    break
+                seen_message_ids.update(message_to_thread)
 
+            max_history_id = _checkpoint_history_id(
+                gmail_account, page_history_id, max_history_id
+            )
+    except googleapiclient.errors.HttpError as e:
+        # history id is too old (or invalid), start over with a full sync
+        if _is_not_found_error(e):
+            gmail_account.reload()
+            gmail_account.last_historyid = 0
+            gmail_account.save(ignore_permissions=True)
+            frappe.db.commit()  # nosemgrep
+            return total_processed
+        frappe.log_error(frappe.get_traceback(), "Gmail Thread Sync Error")
+    except Exception:
+        frappe.log_error(frappe.get_traceback(), "Gmail Thread Sync Error")
 
-def update_involved_users(doc, involved_users):
-    involved_users = list(involved_users)
-    involved_users_linked = [x.account for x in doc.involved_users]
-    all_users = frappe.get_all(
-        "User",
-        filters={"email": ["in", involved_users], "user_type": ["!=", "Website User"]},
-        fields=["name"],
+    logger.info(
+        f"gmail_sync: incremental account={gmail_account.name} processed={total_processed} "
+        f"history_id={max_history_id} elapsed_s={round(time.time() - start_time, 2)}"
     )
-    for user in all_users:
-        if user.name not in involved_users_linked:
-            involved_user = frappe.get_doc(doctype="Involved User", account=user.name)
-            doc.append("involved_users", involved_user)
+    for doctype, docname in updated_docs:
+        frappe.publish_realtime(
+            "gthread_new_email",
+            doctype=doctype,
+            docname=docname,
+        )
+    return total_processed
+
+
+def get_involved_user_accounts(involved_users) -> List[str]:
+    """Return the desk users (not website users) matching the given email addresses."""
+    return get_system_users(involved_users)
+
+
+def update_involved_users(doc, involved_users):
+    involved_users_linked = {x.account for x in doc.involved_users}
+    for account in get_involved_user_accounts(involved_users):
+        if account not in involved_users_linked:
+            doc.append("involved_users", {"account": account})
+
+
+def on_doctype_update():
+    # timeline lookup of threads linked to a document
+    frappe.db.add_index("Gmail Thread", ["reference_doctype", "reference_name"])
 
 
 def get_permission_query_conditions(user):
@@ -1,9 +1,14 @@
 # Copyright (c) 2024, rtCamp and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class InvolvedUser(Document):
     pass
+
+
+def on_doctype_update():
+    # thread permission checks filter by account, alone or with the thread
+    frappe.db.add_index("Involved User", ["account", "parent"])
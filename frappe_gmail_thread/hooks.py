@@ -143,11 +143,13 @@ has_permission = {
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"Communication": {
-# 		"after_insert": "frappe_gmail_thread.doc_events.communication.after_insert",
-# 	},
-# }
+doc_events = {
+    "User": {
+        "on_change": "frappe_gmail_thread.doc_events.user.on_change",
+        "after_rename": "frappe_gmail_thread.doc_events.user.after_rename",
+        "on_trash": "frappe_gmail_thread.doc_events.user.on_trash",
+    },
+}
 
 # Fixtures
 # ----------
@@ -0,0 +1,11 @@
+from frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_thread.gmail_thread import (
+    on_doctype_update as add_gmail_thread_indexes,
+)
+from frappe_gmail_thread.frappe_gmail_thread.doctype.involved_user.involved_user import (
+    on_doctype_update as add_involved_user_indexes,
+)
+
+
+def execute():
+    add_gmail_thread_indexes()
+    add_involved_user_indexes()
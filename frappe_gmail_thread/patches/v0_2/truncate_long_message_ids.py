@@ -0,0 +1,22 @@
+import frappe
+
+from frappe_gmail_thread.utils.helpers import MESSAGE_ID_MAX_LENGTH
+
+
+def execute():
+    truncate_long_message_ids()
+
+
+def truncate_long_message_ids():
+    # email_message_id becomes an indexed Data field; longer values would
+    # make the column change fail
+    if not frappe.db.has_column("Single Email CT", "email_message_id"):
+        return
+    frappe.db.sql(
+        """
+        update `tabSingle Email CT`
+        set email_message_id = left(email_message_id, %(length)s)
+        where char_length(email_message_id) > %(length)s
+        """,
+        {"length": MESSAGE_ID_MAX_LENGTH},
+    )
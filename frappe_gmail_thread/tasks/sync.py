@@ -1,6 +1,35 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import frappe
 from frappe.utils.background_jobs import is_job_enqueued
 
+from frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_thread.gmail_thread import (
+    sync,
+)
+from frappe_gmail_thread.utils.concurrency import site_connection
+from frappe_gmail_thread.utils.parse_pool import parse_pool_scope
+
+logger = frappe.logger("gmail_sync")
+
+# Accounts per worker thread of one sync_accounts job; each job of a cycle
+# syncs one chunk of the accounts
+ACCOUNTS_PER_WORKER = 5
+
+# Seconds a sync job may run. The sync lock of an account expires soon after
+# its job is killed (see SYNC_LOCK_TIMEOUT), so the next cycle picks it up.
+SYNC_JOB_TIMEOUT = 60 * 60
+
+
+def _get_sync_workers() -> int:
+    try:
+        return int(
+            frappe.db.get_single_value("Google Settings", "custom_gmail_sync_workers")
+            or 0
+        )
+    except Exception:
+        return 0
+
 
 def sync_emails():
     gmail_accounts = frappe.get_all(
@@ -8,16 +37,81 @@ def sync_emails():
         filters={"gmail_enabled": 1},
         fields=["name"],
     )
+    users = []
     for gmail_account in gmail_accounts:
         gaccount = frappe.get_doc("Gmail Account", gmail_account.name)
         if gaccount.refresh_token:
-            user = gaccount.linked_user
-            job_name = f"gmail_thread_sync_{user}"
+            users.append(gaccount.linked_user)
+    if not users:
+        return
+
+    workers = _get_sync_workers()
+    if workers > 0:
+        chunk_size = workers * ACCOUNTS_PER_WORKER
+        for index in range(0, len(users), chunk_size):
+            job_name = f"gmail_thread_sync_accounts_{index // chunk_size}"
             if not is_job_enqueued(job_name):
                 frappe.enqueue(
-                    "frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_thread.gmail_thread.sync",
-                    user=user,
+                    "frappe_gmail_thread.tasks.sync.sync_accounts",
+                    users=users[index : index + chunk_size],
+                    workers=workers,
                     queue="long",
+                    timeout=SYNC_JOB_TIMEOUT,
                     job_name=job_name,
                     job_id=job_name,
                 )
+        return
+
+    for user in users:
+        job_name = f"gmail_thread_sync_{user}"
+        if not is_job_enqueued(job_name):
+            frappe.enqueue(
+                "frappe_gmail_thread.frappe_gmail_thread.doctype.gmail_thread.gmail_thread.sync",
+                user=user,
+                queue="long",
+                timeout=SYNC_JOB_TIMEOUT,
+                job_name=job_name,
+                job_id=job_name,
+            )
+
+
+def _sync_user(site: str, sites_path: str, user: str):
+    """Sync one account on a worker thread; returns None if the sync failed."""
+    with site_connection(site, sites_path):
+        try:
+            return sync(user) or 0
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), "Gmail Thread Sync Error")
+            frappe.db.commit()  # nosemgrep
+            return None
+
+
+def sync_accounts(users, workers: int):
+    """Sync the accounts of `users` on `workers` threads and log the cycle's throughput."""
+    site = frappe.local.site
+    sites_path = frappe.local.sites_path
+    start_time = time.time()
+    # the accounts of the job share one parse pool
+    with parse_pool_scope():
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(
+                executor.map(lambda user: _sync_user(site, sites_path, user), users)
+            )
+    elapsed = time.time() - start_time
+
+    processed = sum(result for result in results if result)
+    stats = {
+        "accounts": len(users),
+        "failed": results.count(None),
+        "processed": processed,
+        "workers": workers,
+        "elapsed_s": round(elapsed, 2),
+        "accounts_per_min": round(len(users) * 60 / elapsed, 2) if elapsed else 0,
+        "messages_per_s": round(processed / elapsed, 2) if elapsed else 0,
+    }
+    logger.info(
+        "gmail_sync: cycle "
+        + " ".join(f"{key}={value}" for key, value in stats.items())
+    )
+    return stats
@@ -0,0 +1,124 @@
+"""Micro-benchmarks for the sync pipeline, run with `bench --site <site> execute`."""
+
+import time
+
+import google.oauth2.credentials
+
+
+def _time_calls(fn, iterations):
+    start = time.perf_counter()
+    first = None
+    for i in range(iterations):
+        fn()
+        if i == 0:
+            first = time.perf_counter() - start
+    total = time.perf_counter() - start
+    return {
+        "first_ms": round(first * 1000, 3),
+        "avg_ms": round(total / iterations * 1000, 3),
+    }
+
+
+def benchmark_client_construction(iterations=20):
+    """Compare `build()` with building the Gmail client from the bundled document."""
+    from googleapiclient.discovery import build
+
+    from frappe_gmail_thread.api.oauth import build_gmail
+
+    iterations = int(iterations)
+    credentials = google.oauth2.credentials.Credentials(token="benchmark")
+    result = {
+        "discovery_build": _time_calls(
+            lambda: build(serviceName="gmail", version="v1", credentials=credentials),
+            iterations,
+        ),
+        "bundled_document": _time_calls(lambda: build_gmail(credentials), iterations),
+    }
+    return result
+
+
+def _load_eml_messages(directory):
+    import base64
+    import os
+
+    messages = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith(".eml"):
+            continue
+        with open(os.path.join(directory, file_name), "rb") as f:
+            messages[file_name] = {
+                "id": file_name,
+                "raw": base64.urlsafe_b64encode(f.read()).decode("ascii"),
+            }
+    return messages
+
+
+def benchmark_parse_processes(directory, processes=4, iterations=3):
+    """Compare parsing the .eml files of `directory` in the job and on a parse pool."""
+    from frappe_gmail_thread.utils.helpers import ParsedEmail, parse_raw_email
+    from frappe_gmail_thread.utils.parse_pool import parse_pool_scope, parse_raw_emails
+
+    processes = int(processes)
+    iterations = int(iterations)
+    messages = _load_eml_messages(directory)
+    if not messages:
+        return {"messages": 0, "error": f"No .eml files in {directory}"}
+
+    def parse_in_job():
+        for raw_email in messages.values():
+            ParsedEmail.from_mail(parse_raw_email(raw_email))
+
+    def parse_in_processes():
+        # a pool per run, as a sync job starts one, so its start-up is timed
+        with parse_pool_scope():
+            parse_raw_emails(messages, processes)
+
+    in_job = _time_calls(parse_in_job, iterations)
+    in_processes = _time_calls(parse_in_processes, iterations)
+    result = {
+        "messages": len(messages),
+        "processes": processes,
+        "in_job": in_job,
+        "in_processes": in_processes,
+        "speedup": round(in_job["avg_ms"] / in_processes["avg_ms"], 2)
+        if in_processes["avg_ms"]
+        else None,
+    }
+    return result
+
+
+def _adversarial_quote_texts(size):
+    return {
+        # many attribution-like lines, none of them ending in "wrote:"
+        "on_lines": ("On\n" * (size // 3 + 1))[:size],
+        # a single huge line starting like an attribution
+        "long_line": "On " + "x" * size,
+        # a pasted log without any quote
+        "log": (
+            "2026-10-18 12:00:00 INFO worker: On retry, job wrote: 0 rows\n"
+            * (size // 60 + 1)
+        )[:size],
+        # a long reply quoted with ">"
+        "quoted": "Reply\n" + "> quoted line\n" * (size // 14 + 1),
+    }
+
+
+def benchmark_quoted_reply_removal(size_kb=16, iterations=3, include_regex=1):
+    """Time remove_quoted_text and the regex it replaced on adversarial texts."""
+    import re
+
+    from frappe_gmail_thread.utils.helpers import remove_quoted_text
+
+    size = int(size_kb) * 1024
+    iterations = int(iterations)
+    old_regex = re.compile(r"(\n|^)(On(.|\n)*?wrote:)((.|\n)*)")
+    result = {}
+    for name, text in _adversarial_quote_texts(size).items():
+        result[name] = {
+            "line_oriented": _time_calls(lambda: remove_quoted_text(text), iterations)
+        }
+        if int(include_regex):
+            result[name]["regex"] = _time_calls(
+                lambda: old_regex.sub("", text), iterations
+            )
+    return result
@@ -0,0 +1,140 @@
+"""Helpers to run sync work on threads of the current job, each with its own site connection."""
+
+import queue
+import threading
+from contextlib import contextmanager
+
+import frappe
+
+# Seconds a blocked queue operation waits before checking whether the
+# pipeline was stopped
+QUEUE_POLL_SECONDS = 0.5
+
+
+@contextmanager
+def site_connection(site: str, sites_path: str):
+    """Initialise and connect the site on the current thread, and tear it down after."""
+    frappe.init(site=site, sites_path=sites_path)
+    try:
+        frappe.connect()
+        yield
+    finally:
+        frappe.destroy()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+def run_pipeline(
+    items, fetch, parse, write, workers: int = 2, queue_size: int = None, discard=None
+) -> bool:
+    """Run `items` through fetch, parse and write stages; returns True once all are written."""
+    # fetch and parse run on worker threads, write on the caller's connection;
+    # bounded queues block a stage that gets ahead, and `write` returning
+    # False stops the pipeline, with the parsed items left passed to `discard`
+    site = frappe.local.site
+    sites_path = frappe.local.sites_path
+    queue_size = queue_size or workers
+    tasks = queue.Queue()
+    for item in items:
+        tasks.put(item)
+    parse_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(q, value):
+        # give up once the pipeline stops, so no worker blocks forever
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=QUEUE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def discard_parsed(value):
+        if discard is None or value is _DONE or isinstance(value, _Failure):
+            return
+        try:
+            discard(value)
+        except Exception:
+            frappe.logger("gmail_sync").warning(
+                "gmail_sync: could not discard a pipeline item", exc_info=True
+            )
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=QUEUE_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def fetch_worker():
+        try:
+            with site_connection(site, sites_path):
+                while not stop.is_set():
+                    try:
+                        item = tasks.get_nowait()
+                    except queue.Empty:
+                        return
+                    put(parse_queue, fetch(item))
+        except Exception as e:
+            put(parse_queue, _Failure(e))
+
+    def parse_worker():
+        try:
+            with site_connection(site, sites_path):
+                while True:
+                    value = get(parse_queue)
+                    if value is _DONE:
+                        return
+                    if not isinstance(value, _Failure):
+                        try:
+                            value = parse(value)
+                        except Exception as e:
+                            value = _Failure(e)
+                    if not put(write_queue, value):
+                        discard_parsed(value)
+        except Exception as e:
+            put(write_queue, _Failure(e))
+
+    def coordinator():
+        # close each stage once the stage feeding it has finished
+        fetchers = [threading.Thread(target=fetch_worker) for _i in range(workers)]
+        parsers = [threading.Thread(target=parse_worker) for _i in range(workers)]
+        for thread in fetchers + parsers:
+            thread.start()
+        for thread in fetchers:
+            thread.join()
+        for _thread in parsers:
+            put(parse_queue, _DONE)
+        for thread in parsers:
+            thread.join()
+        put(write_queue, _DONE)
+
+    coordinator_thread = threading.Thread(target=coordinator)
+    coordinator_thread.start()
+    try:
+        while True:
+            value = write_queue.get()
+            if value is _DONE:
+                return True
+            if isinstance(value, _Failure):
+                raise value.error
+            if write(value) is False:
+                return False
+    finally:
+        stop.set()
+        coordinator_thread.join()
+        # parsed items still queued once the pipeline stopped early
+        while True:
+            try:
+                discard_parsed(write_queue.get_nowait())
+            except queue.Empty:
+                break
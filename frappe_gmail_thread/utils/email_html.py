@@ -0,0 +1,70 @@
+"""Cleaning of the HTML of incoming emails."""
+
+from bs4 import BeautifulSoup
+from frappe.utils import sanitize_html
+
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# dropped with their content, bleach would only strip the tags
+DROPPED_ELEMENTS = [
+    "script",
+    "noscript",
+    "iframe",
+    "frame",
+    "frameset",
+    "object",
+    "embed",
+    "applet",
+    "template",
+]
+# elements browsers parse as raw text in HTML but as markup inside svg and
+# math (foreign content), the usual way to smuggle markup past a sanitiser
+RAW_TEXT_ELEMENTS = [
+    "style",
+    "script",
+    "xmp",
+    "iframe",
+    "noembed",
+    "noframes",
+    "noscript",
+    "plaintext",
+    "textarea",
+    "title",
+]
+
+
+def _prefilter_tree(soup, strip_quotes):
+    if strip_quotes:
+        # only works for gmail
+        for div in soup.find_all("div", class_="gmail_quote"):
+            div.decompose()
+    for tag in soup.find_all(DROPPED_ELEMENTS):
+        if not tag.decomposed:
+            tag.decompose()
+    for foreign in soup.find_all(["svg", "math"]):
+        if foreign.decomposed:
+            continue
+        for tag in foreign.find_all(RAW_TEXT_ELEMENTS):
+            if not tag.decomposed:
+                tag.decompose()
+
+
+def clean_email_html(html: str, strip_quotes: bool = True, parser: str = HTML_PARSER):
+    """Strip Gmail quoted replies from `html`; returns `(sanitised_html, text)`."""
+    if not html:
+        return html, ""
+    soup = BeautifulSoup(html, parser)
+    _prefilter_tree(soup, strip_quotes)
+    text = soup.get_text(separator=" ", strip=True)
+    # the tree is only a pre-filter, bleach stays the XSS defence
+    return sanitize_html(str(soup), always_sanitize=True), text
+
+
+def sanitize_email_html(html: str) -> str:
+    """Sanitise an HTML fragment, e.g. a plain text part converted to HTML."""
+    return clean_email_html(html, strip_quotes=False, parser="html.parser")[0]
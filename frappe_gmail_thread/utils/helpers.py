@@ -1,44 +1,119 @@
 import base64
+import binascii
+import hashlib
 import json
+import mimetypes
+import os
 import re
+import shutil
+import tempfile
+from email.header import decode_header, make_header
+from contextlib import contextmanager
+from functools import partial
+from html import escape
 from uuid import uuid4
 
 import frappe
-from bs4 import BeautifulSoup
 from frappe.email.receive import Email, MaxFileSizeReachedError
-from frappe.utils import extract_email_id, sanitize_html
+from frappe.utils import extract_email_id
+from frappe.utils.file_manager import get_max_file_size
 
+from frappe_gmail_thread.utils.email_html import clean_email_html, sanitize_email_html
+from frappe_gmail_thread.utils.users import get_system_user
 
-class GmailInboundMail(Email):
-    def __init__(self, content):
-        super().__init__(content)
-        # remove quoted replies from email text content
-        self.text_content = self.remove_quoted_replies(self.text_content, "text")
-        self.html_content = self.remove_quoted_replies(self.html_content, "html")
-        self.set_content_and_type()
-        self.set_to_and_cc()
+# Length of the indexed Single Email CT.email_message_id column
+MESSAGE_ID_MAX_LENGTH = 255
+
+# Line patterns of quoted replies in plain text emails; each is matched
+# against a single line, so stripping stays linear in the length of the text
+GMAIL_ATTRIBUTION_START = re.compile(r"^\s*On\s")
+GMAIL_ATTRIBUTION_END = re.compile(r"wrote:\s*$")
+OUTLOOK_ORIGINAL_MESSAGE = re.compile(
+    r"^\s*-{3,}\s*Original Message\s*-{3,}\s*$", re.IGNORECASE
+)
+OUTLOOK_SEPARATOR = re.compile(r"^\s*_{10,}\s*$")
+OUTLOOK_FROM = re.compile(r"^\s*\*?From:\*?\s", re.IGNORECASE)
+OUTLOOK_HEADER = re.compile(r"^\s*\*?(Sent|Date|To|Subject):\*?\s", re.IGNORECASE)
+QUOTED_LINE = re.compile(r"^\s*>")
 
+# Lines an attribution or an Outlook header block may be wrapped over
+QUOTE_HEADER_MAX_LINES = 4
+QUOTE_HEADER_FIRST_CHARACTERS = frozenset("O-_Ff*")
+
+# Attachments with a larger encoded payload are decoded to a temporary file
+# instead of memory; chunks are a multiple of 4 base64 characters
+STREAMED_ATTACHMENT_MIN_SIZE = 256 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_TEMP_PREFIX = "gmail-attachment-"
+NON_BASE64_CHARACTERS = re.compile(r"[^A-Za-z0-9+/=]+")
+
+
+class InlineImagesMixin:
     def replace_inline_images(self, attachments):
-        # replace inline images
+        # replace inline images; content is already sanitised, so only the
+        # inserted urls have to be escaped
         content = self.content
         for file in json.loads(attachments):
             file = frappe.get_doc("File", file["file_doc_name"])
             if self.cid_map.get(file.name):
                 content = content.replace(
-                    f"cid:{self.cid_map[file.name]}", file.unique_url
+                    f"cid:{self.cid_map[file.name]}", escape(file.unique_url)
                 )
         return content
 
+
+class GmailInboundMail(InlineImagesMixin, Email):
+    def __init__(self, content):
+        super().__init__(content)
+        # remove quoted replies from email text content
+        self.text_content = self.remove_quoted_replies(self.text_content, "text")
+        # quoted replies are removed from the html, and the html is sanitised
+        # and converted to text, on a single parsed tree
+        self.html_content, self.html_text = clean_email_html(self.html_content)
+        self.set_content_and_type()
+        if self.content_type != "text/html":
+            self.content = sanitize_email_html(self.content)
+        self.set_to_and_cc()
+
+    @property
+    def references(self):
+        return self.mail.get("References")
+
+    def get_attachment(self, part):
+        payload = part.get_payload()
+        if not isinstance(payload, str) or len(payload) < STREAMED_ATTACHMENT_MIN_SIZE:
+            return super().get_attachment(part)
+
+        content_type = part.get_content_type()
+        fname = get_part_filename(part) or get_random_part_filename(content_type)
+        # Don't clobber existing filename
+        while fname in self.cid_map:
+            fname = get_random_part_filename(content_type)
+        # large attachments are decoded straight to disk, see process_attachments
+        streamed = stream_part_to_file(part)
+        if not streamed:
+            return
+        path, size, content_hash = streamed
+        self.attachments.append(
+            {
+                "content_type": content_type,
+                "fname": fname,
+                "fpath": path,
+                "fsize": size,
+                "content_hash": content_hash,
+            }
+        )
+        cid = str(part.get("Content-Id") or "").strip("><")
+        if cid:
+            self.cid_map[fname] = cid
+
+    @property
+    def plain_content(self):
+        return self.text_content.strip() or self.html_text
+
     def remove_quoted_replies(self, content, type):
         if type == "text":
-            regex = r"(\n|^)(On(.|\n)*?wrote:)((.|\n)*)"
-            return re.sub(regex, "", content)
-        if type == "html":
-            soup = BeautifulSoup(content, "html.parser")
-            # only works for gmail
-            for div in soup.find_all("div", class_="gmail_quote"):
-                div.decompose()
-            return str(soup)
+            return remove_quoted_text(content)
 
     def set_to_and_cc(self):
         """
@@ -57,74 +132,299 @@ class GmailInboundMail(Email):
         return []
 
 
-def html_to_text(html):
-    soup = BeautifulSoup(html, "html.parser")
-    return soup.get_text(separator=" ", strip=True)
+def _is_quote_header(lines, index, check_attribution=True):
+    line = lines[index]
+    # cheap check first, most lines cannot start a quote header
+    if line.lstrip()[:1] not in QUOTE_HEADER_FIRST_CHARACTERS:
+        return False
+    if OUTLOOK_ORIGINAL_MESSAGE.match(line):
+        return True
+    if GMAIL_ATTRIBUTION_START.match(line):
+        if not check_attribution:
+            return False
+        # "On <date>, <name> wrote:", possibly wrapped over a few lines
+        for attribution_line in lines[index : index + QUOTE_HEADER_MAX_LINES]:
+            if GMAIL_ATTRIBUTION_END.search(attribution_line):
+                return True
+            if not attribution_line.strip():
+                return False
+        return False
+    if OUTLOOK_SEPARATOR.match(line):
+        return index + 1 < len(lines) and bool(OUTLOOK_FROM.match(lines[index + 1]))
+    if OUTLOOK_FROM.match(line):
+        # "From:" followed by "Sent:"/"To:"/"Subject:" header lines
+        headers = lines[index + 1 : index + 3]
+        return bool(headers) and all(OUTLOOK_HEADER.match(header) for header in headers)
+    return False
 
 
-def find_gmail_thread(thread_id, message_ids: list = None):
+def remove_quoted_text(text):
+    """Remove the quoted reply from a plain text email, in linear time."""
+    if not text:
+        return text
+    lines = text.splitlines(keepends=True)
+    check_attribution = "wrote:" in text
+    cut = None
+    for index in range(len(lines)):
+        if _is_quote_header(lines, index, check_attribution):
+            cut = index
+            break
+    if cut is None:
+        # trailing block of quoted (or blank) lines
+        index = len(lines)
+        quoted = False
+        while index > 0:
+            if QUOTED_LINE.match(lines[index - 1]):
+                quoted = True
+            elif lines[index - 1].strip():
+                break
+            index -= 1
+        if quoted:
+            cut = index
+    if cut is None:
+        return text
+    return "".join(lines[:cut]).rstrip()
+
+
+def get_part_filename(part):
+    fname = part.get_filename()
+    if not fname:
+        return None
     try:
-        gmail_thread = frappe.get_doc("Gmail Thread", {"gmail_thread_id": thread_id})
-    except frappe.DoesNotExistError:
-        gmail_thread = None
-        if message_ids:
-            for message_id in message_ids:
-                try:
-                    single_email_ct = frappe.get_doc(
-                        "Single Email CT", {"email_message_id": message_id}
-                    )
-                    if single_email_ct:
-                        gmail_thread = frappe.get_doc(
-                            "Gmail Thread", single_email_ct.parent
-                        )
-                        break
-                except frappe.DoesNotExistError:
-                    pass
-    return gmail_thread
+        fname = fname.replace("\n", " ").replace("\r", "")
+        return str(make_header(decode_header(fname)))
+    except Exception:
+        return None
+
+
+def get_random_part_filename(content_type):
+    return uuid4().hex + (mimetypes.guess_extension(content_type) or "")
+
+
+def _iter_base64_chunks(payload):
+    pending = ""
+    for start in range(0, len(payload), STREAM_CHUNK_SIZE):
+        chunk = payload[start : start + STREAM_CHUNK_SIZE]
+        pending += NON_BASE64_CHARACTERS.sub("", chunk)
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            yield binascii.a2b_base64(pending[:usable])
+            pending = pending[usable:]
+    if len(pending) > 1:
+        # unpadded tail
+        yield binascii.a2b_base64(pending + "=" * (-len(pending) % 4))
+
+
+def _iter_decoded_payload(part):
+    encoding = str(part.get("Content-Transfer-Encoding") or "").strip().lower()
+    if encoding != "base64":
+        # quoted-printable and 8bit encodings are rare for large attachments
+        yield part.get_payload(decode=True) or b""
+        return
+    yield from _iter_base64_chunks(part.get_payload())
+
+
+def _write_to_temp_file(chunks):
+    content_hash = hashlib.md5()
+    size = 0
+    fd, path = tempfile.mkstemp(prefix=ATTACHMENT_TEMP_PREFIX)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                content_hash.update(chunk)
+                size += len(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    if not size:
+        os.remove(path)
+        return None
+    return path, size, content_hash.hexdigest()
+
+
+def stream_part_to_file(part):
+    """Decode a MIME part to a temporary file; returns `(path, size, hash)` or None."""
+    return _write_to_temp_file(_iter_decoded_payload(part))
+
+
+def discard_attachment_files(email_object):
+    """Remove the temporary files of streamed attachments that were not saved."""
+    for attachment in email_object.attachments or []:
+        path = attachment.pop("fpath", None)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+class ParsedEmail(InlineImagesMixin):
+    """The parts of a GmailInboundMail storing needs, cheap to send across processes."""
+
+    FIELDS = (
+        "message_id",
+        "subject",
+        "from_email",
+        "from_real_name",
+        "to",
+        "cc",
+        "bcc",
+        "date",
+        "references",
+        "content",
+        "plain_content",
+        "attachments",
+        "cid_map",
+    )
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def from_mail(cls, mail):
+        return cls(**{field: getattr(mail, field) for field in cls.FIELDS})
+
+
+def normalize_message_id(message_id):
+    """Trim a Message-ID to the stored column length, so lookups match stored values."""
+    if isinstance(message_id, str):
+        return message_id[:MESSAGE_ID_MAX_LENGTH]
+    return message_id
+
+
+class GmailThreadResolver:
+    """Find the Gmail Threads of a batch by thread id and referenced Message-IDs."""
+
+    THREAD_FIELDS = [
+        "name",
+        "gmail_thread_id",
+        "owner",
+        "subject_of_first_mail",
+        "reference_doctype",
+        "reference_name",
+    ]
+
+    def __init__(self, references: dict):
+        """`references` maps Gmail thread ids to the Message-IDs they reference."""
+        self.references = {
+            thread_id: [normalize_message_id(m) for m in message_ids if m]
+            for thread_id, message_ids in references.items()
+        }
+        self.by_thread_id = {}
+        self.by_message_id = {}
+        if not self.references:
+            return
+        for row in frappe.get_all(
+            "Gmail Thread",
+            filters={"gmail_thread_id": ["in", list(self.references)]},
+            fields=self.THREAD_FIELDS,
+        ):
+            self.by_thread_id[row.gmail_thread_id] = row
+
+        message_ids = {
+            message_id
+            for thread_id, message_ids in self.references.items()
+            if thread_id not in self.by_thread_id
+            for message_id in message_ids
+        }
+        if not message_ids:
+            return
+        for row in frappe.get_all(
+            "Gmail Thread",
+            filters=[["Single Email CT", "email_message_id", "in", list(message_ids)]],
+            fields=self.THREAD_FIELDS + ["`tabSingle Email CT`.email_message_id"],
+        ):
+            self.by_message_id.setdefault(row.pop("email_message_id"), row)
+
+    def get(self, thread_id):
+        """Return the stored thread of a Gmail thread id, or None to create one."""
+        gmail_thread = self.by_thread_id.get(thread_id)
+        if gmail_thread:
+            return gmail_thread
+        for message_id in self.references.get(thread_id, []):
+            if message_id in self.by_message_id:
+                return self.by_message_id[message_id]
+        return None
+
+    def add(self, thread_id, gmail_thread, message_ids: list):
+        """Register the thread the messages of `thread_id` were written to."""
+        self.by_thread_id[thread_id] = gmail_thread
+        for message_id in message_ids:
+            if message_id:
+                self.by_message_id.setdefault(
+                    normalize_message_id(message_id), gmail_thread
+                )
+
+
+def get_message_header(message: dict, name: str):
+    """Return a header value from a Gmail API message resource."""
+    name = name.lower()
+    for header in message.get("payload", {}).get("headers", []):
+        if header.get("name", "").lower() == name:
+            return header.get("value")
+    return None
+
+
+def get_threads_by_message_ids(message_ids: list) -> dict:
+    """Map already stored RFC Message-IDs to their Gmail Thread."""
+    if not message_ids:
+        return {}
+    return {
+        row.email_message_id: row.parent
+        for row in frappe.get_all(
+            "Single Email CT",
+            filters={
+                "email_message_id": ["in", list(message_ids)],
+                "parenttype": "Gmail Thread",
+            },
+            fields=["email_message_id", "parent"],
+        )
+    }
+
+
+def get_synced_gmail_message_ids(gmail_message_ids: list) -> set:
+    """Return the Gmail message ids that are already stored."""
+    if not gmail_message_ids:
+        return set()
+    return set(
+        frappe.get_all(
+            "Single Email CT",
+            filters={"gmail_message_id": ["in", list(gmail_message_ids)]},
+            pluck="gmail_message_id",
+        )
+    )
 
 
 class AlreadyExistsError(Exception):
-    pass
+    def __init__(self, thread_name=None):
+        super().__init__(thread_name)
+        self.thread_name = thread_name
 
 
-def create_new_email(email, gmail_account):
+def parse_raw_email(email):
+    """Decode and parse a Gmail message fetched in raw format."""
     # decode raw email with errors='replace' to avoid UnicodeDecodeError
     email_content = base64.urlsafe_b64decode(email["raw"].encode("ASCII")).decode(
         "utf-8", errors="replace"
     )
-    email_object = GmailInboundMail(content=email_content)
+    return GmailInboundMail(content=email_content)
+
+
+def create_new_email(email, gmail_account, email_object=None):
+    if email_object is None:
+        email_object = parse_raw_email(email)
     # check if email is sent or received
-    is_sent = False
     # check if there is a user (not website user) with the same email as the sender in frappe, if yes, then it is a sent email
-    is_sent = (
-        frappe.db.exists(
-            "User",
-            {"email": email_object.from_email, "user_type": ["!=", "Website User"]},
-        )
-        and True
-        or False
-    )
+    is_sent = bool(get_system_user(email_object.from_email))
 
-    try:
-        email_ct = frappe.get_doc(
-            "Single Email CT", {"email_message_id": email_object.message_id}
+    if email_object.message_id:
+        thread_name = frappe.db.get_value(
+            "Single Email CT",
+            {"email_message_id": normalize_message_id(email_object.message_id)},
+            "parent",
         )
-        if email_ct:
-            gmail_thread = frappe.get_doc("Gmail Thread", email_ct.parent)
-            involved_users_linked = [
-                user.account for user in gmail_thread.involved_users
-            ]
-
-            if gmail_account.linked_user not in involved_users_linked:
-                involved_user = frappe.get_doc(
-                    doctype="Involved User", account=gmail_account.linked_user
-                )
-                gmail_thread.append("involved_users", involved_user)
-                gmail_thread.save(ignore_permissions=True)
-
-            raise AlreadyExistsError
-    except frappe.DoesNotExistError:
-        pass
+        if thread_name:
+            discard_attachment_files(email_object)
+            raise AlreadyExistsError(thread_name)
 
     def safe_str(val):
         # Ensure string is safe for DB, replace surrogates and invalid chars
@@ -140,9 +440,9 @@ def create_new_email(email, gmail_account):
     new_email.cc = safe_str(", ".join(email_object.cc).strip())
     new_email.bcc = safe_str(", ".join(email_object.bcc).strip())
     new_email.content = safe_str(email_object.content)
-    new_email.plain_content = safe_str(
-        email_object.text_content.strip() or html_to_text(email_object.html_content)
-    )
+    # parsing sanitised it already, see GmailThread.sanitize_email_content
+    new_email.flags.content_sanitized = True
+    new_email.plain_content = safe_str(email_object.plain_content)
     new_email.date_and_time = email_object.date
     new_email.sender_full_name = safe_str(email_object.from_real_name)
     new_email.read_receipt = False
@@ -150,7 +450,7 @@ def create_new_email(email, gmail_account):
     new_email.read_by_recipient_on = None
     new_email.gmail_account = gmail_account.name
     new_email.email_status = "Open"
-    new_email.email_message_id = safe_str(email_object.message_id)
+    new_email.email_message_id = normalize_message_id(safe_str(email_object.message_id))
     new_email.linked_communication = None
     new_email.sent_or_received = "Sent" if is_sent else "Received"
     # save attachments to private files
@@ -175,32 +475,210 @@ def create_new_email(email, gmail_account):
 
 def replace_inline_images(new_email, email_object):
     if new_email.attachments_data:
-        new_email.content = sanitize_html(
-            email_object.replace_inline_images(new_email.attachments_data)
+        new_email.content = email_object.replace_inline_images(
+            new_email.attachments_data
         )
 
 
+def _get_private_file_name(file_name, content_hash):
+    # same naming as File uses for clashing file names
+    files_path = frappe.get_site_path("private", "files")
+    if not os.path.exists(os.path.join(files_path, file_name)):
+        return file_name
+    name, extension = os.path.splitext(file_name)
+    stored_name = f"{name}{content_hash[-6:]}{extension}"
+    while os.path.exists(os.path.join(files_path, stored_name)):
+        stored_name = f"{name}{uuid4().hex[:6]}{extension}"
+    return stored_name
+
+
+def get_content_hash(content):
+    """md5 of attachment content, the hash `File` stores as `content_hash`."""
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.md5(content).hexdigest()
+
+
+def get_stored_attachment_files(content_hashes, attached_to_name):
+    """Return the thread's Files and the URL of any stored copy, by content hash."""
+    thread_files = {}
+    file_urls = {}
+    if not content_hashes:
+        return thread_files, file_urls
+    for row in frappe.get_all(
+        "File",
+        filters={
+            "content_hash": ["in", list(set(content_hashes))],
+            "is_private": 1,
+            "is_folder": 0,
+        },
+        fields=[
+            "name",
+            "file_name",
+            "file_url",
+            "is_private",
+            "content_hash",
+            "attached_to_doctype",
+            "attached_to_name",
+        ],
+        order_by="creation asc",
+    ):
+        file_urls.setdefault(row.content_hash, row.file_url)
+        if (
+            row.attached_to_doctype == "Gmail Thread"
+            and row.attached_to_name == attached_to_name
+        ):
+            thread_files.setdefault(row.content_hash, row)
+    return thread_files, file_urls
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+@contextmanager
+def track_written_files():
+    """Collect the paths of the attachment files written in the block."""
+    written_files = []
+    tracked = getattr(frappe.local, "gmail_written_files", None)
+    if tracked is None:
+        tracked = frappe.local.gmail_written_files = []
+    tracked.append(written_files)
+    try:
+        yield written_files
+    finally:
+        tracked.remove(written_files)
+
+
+def remove_written_files(written_files):
+    for path in written_files:
+        _remove_file(path)
+
+
+def _record_written_file(path):
+    # as File does, don't keep the content if the row is rolled back; a
+    # rollback to a savepoint doesn't run after_rollback, so the file is also
+    # recorded for the block tracking it, see track_written_files
+    frappe.db.after_rollback.add(partial(_remove_file, path))
+    for written_files in getattr(frappe.local, "gmail_written_files", None) or []:
+        written_files.append(path)
+
+
+def _insert_stored_file(file_name, file_url, attached_to_name, file_size, content_hash):
+    """Insert the File of an attachment already stored at `file_url`."""
+    # not File.insert, whose before_insert reads the content back into memory
+    # and stores it again; the values it would set are filled in here
+    _file = frappe.new_doc("File")
+    _file.update(
+        {
+            "file_name": file_name,
+            "file_url": file_url,
+            "folder": "Home/Attachments",
+            "attached_to_doctype": "Gmail Thread",
+            "attached_to_name": attached_to_name,
+            "is_private": 1,
+            "file_size": file_size,
+            "content_hash": content_hash,
+        }
+    )
+    mime_type = mimetypes.guess_type(file_name)[0]
+    extension = mime_type and mimetypes.guess_extension(mime_type)
+    _file.file_type = extension.lstrip(".").upper() if extension else None
+    _file.name = frappe.generate_hash(length=10)
+    _file.set_user_and_timestamp()
+    _file.db_insert()
+    return _file
+
+
+def save_streamed_attachment(attachment, file_name, attached_to_name):
+    """Save an attachment decoded to a temporary file without reading it into memory."""
+    path = attachment.pop("fpath")
+    if attachment["fsize"] > get_max_file_size():
+        os.remove(path)
+        raise MaxFileSizeReachedError
+    stored_name = _get_private_file_name(file_name, attachment["content_hash"])
+    stored_path = frappe.get_site_path("private", "files", stored_name)
+    shutil.move(path, stored_path)
+    try:
+        _file = _insert_stored_file(
+            file_name,
+            f"/private/files/{stored_name}",
+            attached_to_name,
+            attachment["fsize"],
+            attachment["content_hash"],
+        )
+    except Exception:
+        os.remove(stored_path)
+        raise
+    _record_written_file(stored_path)
+    return _file
+
+
+def save_attachment(attachment, file_name, attached_to_name, file_url=None):
+    """Save an attachment as a private File, pointing at `file_url` if it is set."""
+    if file_url:
+        path = attachment.pop("fpath", None)
+        if path:
+            os.remove(path)
+        return _insert_stored_file(
+            file_name,
+            file_url,
+            attached_to_name,
+            attachment.get("fsize") or len(attachment["fcontent"]),
+            attachment["content_hash"],
+        )
+    if attachment.get("fpath"):
+        return save_streamed_attachment(attachment, file_name, attached_to_name)
+    _file = frappe.get_doc(
+        {
+            "doctype": "File",
+            "file_name": file_name,
+            "attached_to_doctype": "Gmail Thread",
+            "attached_to_name": attached_to_name,
+            "is_private": 1,
+            "content": attachment["fcontent"],
+        }
+    )
+    _file.save()
+    if _file.flags.new_file:
+        _record_written_file(_file.get_full_path())
+    return _file
+
+
 def process_attachments(new_email, gmail_thread, email_object):
+    """Save the attachments of a parsed email as Files of `gmail_thread`."""
     attachments = []
+    attached_to_name = gmail_thread.name or gmail_thread.gmail_thread_id
+    stored_attachments = []
     for attachment in email_object.attachments:
+        if not attachment.get("content_hash"):
+            attachment["content_hash"] = get_content_hash(attachment["fcontent"])
+        stored_attachments.append(attachment)
+    # attachments are stored once per content: a file already on the thread
+    # is reused, content stored elsewhere only gets a File pointing at it
+    thread_files, file_urls = get_stored_attachment_files(
+        [attachment["content_hash"] for attachment in stored_attachments],
+        attached_to_name,
+    )
+    for attachment in stored_attachments:
         try:
             attachment["mapped_name"] = attachment["fname"]
             if len(attachment["fname"]) >= 140:
                 attachment["mapped_name"] = (
                     str(uuid4()) + "." + attachment["fname"].split(".")[-1]
                 )
-            _file = frappe.get_doc(
-                {
-                    "doctype": "File",
-                    "file_name": attachment["mapped_name"],
-                    "attached_to_doctype": "Gmail Thread",
-                    "attached_to_name": gmail_thread.name
-                    or gmail_thread.gmail_thread_id,
-                    "is_private": 1,
-                    "content": attachment["fcontent"],
-                }
-            )
-            _file.save()
+            content_hash = attachment["content_hash"]
+            _file = thread_files.get(content_hash)
+            if not _file:
+                _file = save_attachment(
+                    attachment,
+                    attachment["mapped_name"],
+                    attached_to_name,
+                    file_urls.get(content_hash),
+                )
+                thread_files[content_hash] = _file
+                file_urls[content_hash] = _file.file_url
             attachments.append(
                 {
                     "file_name": _file.file_name,
@@ -223,4 +701,5 @@ def process_attachments(new_email, gmail_thread, email_object):
         except frappe.DuplicateEntryError:
             # same file attached twice??
             pass
+    discard_attachment_files(email_object)
     new_email.attachments_data = json.dumps(attachments)
@@ -0,0 +1,117 @@
+"""Parse raw Gmail messages on a pool of worker processes."""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Dict
+
+import frappe
+
+from frappe_gmail_thread.utils.helpers import ParsedEmail, parse_raw_email
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+# Callers inside parse_pool_scope; the pool is shut down when the last leaves
+_pool_users = 0
+
+
+def get_parse_processes() -> int:
+    try:
+        processes = frappe.db.get_single_value(
+            "Google Settings", "custom_gmail_parse_processes", cache=True
+        )
+        return max(0, int(processes or 0))
+    except Exception:
+        return 0
+
+
+def _init_worker(site: str, sites_path: str):
+    # parsing reads site settings such as the system time zone
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
+
+
+def _parse(raw_email) -> ParsedEmail:
+    try:
+        return ParsedEmail.from_mail(parse_raw_email(raw_email))
+    except Exception:
+        # parsed again by the job when it stores the message, which records
+        # the error; one bad message must not fail the whole chunk
+        return None
+
+
+def _get_pool(processes: int) -> ProcessPoolExecutor:
+    global _pool, _pool_key
+    key = (frappe.local.site, processes)
+    with _pool_lock:
+        if _pool is None or _pool_key != key:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawned, not forked, so workers share no connections with the job
+            _pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(frappe.local.site, frappe.local.sites_path),
+            )
+            _pool_key = key
+        return _pool
+
+
+def _shutdown_pool(wait: bool):
+    global _pool, _pool_key
+    if _pool is not None:
+        _pool.shutdown(wait=wait)
+    _pool = None
+    _pool_key = None
+
+
+def _reset_pool():
+    with _pool_lock:
+        _shutdown_pool(wait=False)
+
+
+@contextmanager
+def parse_pool_scope():
+    """Shut the parse pool down when the outermost scope of the job exits."""
+    global _pool_users
+    with _pool_lock:
+        _pool_users += 1
+    try:
+        yield
+    finally:
+        with _pool_lock:
+            _pool_users -= 1
+            # work horses end with os._exit, which would leave the workers
+            # and their database connections behind
+            if not _pool_users:
+                _shutdown_pool(wait=True)
+
+
+def parse_raw_emails(
+    raw_emails: Dict[str, Dict], processes: int
+) -> Dict[str, ParsedEmail]:
+    """Parse raw Gmail messages on the pool; messages that cannot be parsed are left out."""
+    if not raw_emails:
+        return {}
+    message_ids = list(raw_emails)
+    # only the fields parsing needs are sent to the workers
+    payloads = [{"id": mid, "raw": raw_emails[mid]["raw"]} for mid in message_ids]
+    pool = _get_pool(processes)
+    try:
+        parsed = list(
+            pool.map(
+                _parse, payloads, chunksize=max(1, len(payloads) // (processes * 4))
+            )
+        )
+    except BrokenProcessPool:
+        _reset_pool()
+        raise
+    return {
+        mid: email_object
+        for mid, email_object in zip(message_ids, parsed)
+        if email_object is not None
+    }
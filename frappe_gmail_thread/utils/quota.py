@@ -0,0 +1,129 @@
+"""Gmail API quota shared by every sync job of the site, as a token bucket in Redis."""
+
+import time
+
+import frappe
+from googleapiclient.http import BatchHttpRequest
+
+# Quota units charged by Gmail per method,
+# see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "watch": 100,
+    "stop": 50,
+    "labels.list": 1,
+    "history.list": 2,
+    "threads.list": 10,
+    "threads.get": 10,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.attachments.get": 5,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+# Default Gmail project quota is 1,200,000 units per minute
+DEFAULT_UNITS_PER_SECOND = 20000
+
+# Longest single sleep, and total wait after which the call runs anyway
+# (Gmail then answers with 429, which the sync already handles)
+MAX_SLEEP_SECONDS = 5
+MAX_WAIT_SECONDS = 300
+
+BUCKET_KEY = "gmail_quota_bucket"
+
+# Refill the bucket for the time elapsed, then take `units` if available.
+# Returns the seconds to wait before `units` are available (0 when taken).
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local units = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local capacity = tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+units = math.min(units, capacity)
+local wait = 0
+if tokens >= units then
+    tokens = tokens - units
+else
+    wait = (units - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+def get_units_per_second() -> int:
+    try:
+        units = frappe.db.get_single_value(
+            "Google Settings", "custom_gmail_quota_units_per_second", cache=True
+        )
+        units = int(units or 0)
+    except Exception:
+        units = 0
+    return units if units > 0 else DEFAULT_UNITS_PER_SECOND
+
+
+def get_method_units(method_id: str) -> int:
+    """Quota units of a discovery method id such as `gmail.users.messages.get`."""
+    method = (method_id or "").removeprefix("gmail.users.")
+    return QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS)
+
+
+def get_request_units(request) -> int:
+    """Quota units of a Gmail API request, or the sum of the requests of a batch."""
+    if isinstance(request, BatchHttpRequest):
+        # BatchHttpRequest keeps the requests added to it by request id
+        return sum(
+            get_method_units(getattr(r, "methodId", None))
+            for r in getattr(request, "_requests", {}).values()
+        )
+    return get_method_units(getattr(request, "methodId", None))
+
+
+def _take(units: int, units_per_second: int) -> float:
+    cache = frappe.cache()
+    wait = cache.eval(
+        TOKEN_BUCKET_SCRIPT,
+        1,
+        cache.make_key(BUCKET_KEY),
+        time.time(),
+        units,
+        units_per_second,
+        units_per_second,
+    )
+    return float(wait or 0)
+
+
+def acquire(units: int) -> float:
+    """Block until `units` are taken from the bucket; returns the seconds waited."""
+    if units <= 0:
+        return 0
+    units_per_second = get_units_per_second()
+    waited = 0
+    while True:
+        try:
+            wait = _take(units, units_per_second)
+        except Exception:
+            frappe.logger("gmail_sync").warning(
+                "gmail_sync: quota bucket unavailable; not throttling", exc_info=True
+            )
+            return waited
+        if wait <= 0:
+            return waited
+        if waited >= MAX_WAIT_SECONDS:
+            frappe.logger("gmail_sync").info(
+                f"gmail_sync: waited {round(waited, 1)}s for {units} quota units; running anyway"
+            )
+            return waited
+        sleep_for = min(wait, MAX_SLEEP_SECONDS)
+        time.sleep(sleep_for)
+        waited += sleep_for
+
+
+def execute(request):
+    """Execute a Gmail API request or batch once the shared quota allows it."""
+    acquire(get_request_units(request))
+    return request.execute()
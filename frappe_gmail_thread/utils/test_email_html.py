@@ -0,0 +1,57 @@
+# Copyright (c) 2026, rtCamp and Contributors
+# See license.txt
+
+from bs4 import BeautifulSoup
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_gmail_thread.utils.email_html import clean_email_html, sanitize_email_html
+
+# known mutation XSS payloads, markup that parses differently once serialised
+MXSS_PAYLOADS = [
+    "<svg><style><img src=x onerror=alert(1)></style></svg>",
+    "<math><style><img src=x onerror=alert(1)></style></math>",
+    "<svg></p><style><a id='</style><img src=1 onerror=alert(1)>'>",
+    "<math><mtext><table><mglyph><style><img src=x onerror=alert(1)>",
+    "<form><math><mtext></form><form><mglyph><style></math><img src onerror=alert(1)>",
+    "<noscript><p title='</noscript><img src=x onerror=alert(1)>'>",
+    "<svg><title><img src=x onerror=alert(1)></title></svg>",
+    "<math><xmp><img src=x onerror=alert(1)></xmp></math>",
+]
+
+
+class TestEmailHTML(FrappeTestCase):
+    def assertSafe(self, html):
+        for parser in ("html.parser", "lxml"):
+            soup = BeautifulSoup(html, parser)
+            self.assertFalse(
+                soup.find_all(["script", "iframe", "object", "embed"]), html
+            )
+            for tag in soup.find_all(True):
+                for name, value in tag.attrs.items():
+                    self.assertFalse(name.lower().startswith("on"), html)
+                    if isinstance(value, str):
+                        self.assertNotIn("javascript:", value.lower(), html)
+
+    def test_mxss_payloads(self):
+        for payload in MXSS_PAYLOADS:
+            html, _text = clean_email_html(payload)
+            self.assertSafe(html)
+            self.assertSafe(sanitize_email_html(payload))
+
+    def test_unsafe_attributes(self):
+        html, _text = clean_email_html(
+            '<a href="javascript:alert(1)">a</a>'
+            '<a href="jav&#x09;ascript:alert(1)">b</a>'
+            '<img src="cid:image001" onload="alert(1)">'
+        )
+        self.assertSafe(html)
+        self.assertIn("cid:image001", html)
+
+    def test_quotes_and_text(self):
+        html, text = clean_email_html(
+            "<div><p>Reply</p><script>alert(1)</script>"
+            '<div class="gmail_quote">On Monday, someone wrote: Original</div></div>'
+        )
+        self.assertIn("Reply", html)
+        self.assertNotIn("Original", html)
+        self.assertEqual(text, "Reply")
@@ -0,0 +1,60 @@
+# Copyright (c) 2026, rtCamp and Contributors
+# See license.txt
+
+import time
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_gmail_thread.utils.helpers import remove_quoted_text
+
+
+class TestRemoveQuotedText(FrappeTestCase):
+    def test_gmail_attribution(self):
+        text = (
+            "Thanks, that works.\n\n"
+            "On Mon, 12 Oct 2026 at 10:00, Jane Doe <jane@example.com>\n"
+            "wrote:\n"
+            "> Does it work?\n"
+        )
+        self.assertEqual(remove_quoted_text(text), "Thanks, that works.")
+
+    def test_outlook_headers(self):
+        text = (
+            "Sounds good.\n"
+            "________________________________\n"
+            "From: Jane Doe <jane@example.com>\n"
+            "Sent: Monday, October 12, 2026 10:00 AM\n"
+            "To: John Doe <john@example.com>\n"
+            "Subject: Plan\n\n"
+            "Original\n"
+        )
+        self.assertEqual(remove_quoted_text(text), "Sounds good.")
+        text = "Sounds good.\n-----Original Message-----\nFrom: Jane\nOriginal\n"
+        self.assertEqual(remove_quoted_text(text), "Sounds good.")
+
+    def test_trailing_quoted_block(self):
+        text = "Yes.\n\n> Can you come?\n>\n> Jane\n\n"
+        self.assertEqual(remove_quoted_text(text), "Yes.")
+
+    def test_text_without_quotes(self):
+        for text in (
+            "",
+            "Plain reply",
+            "On Monday we ship.\nNothing was written.",
+            "> quoted first\nthen a reply",
+        ):
+            self.assertEqual(remove_quoted_text(text), text)
+
+    def test_large_input(self):
+        size = 512 * 1024
+        texts = [
+            ("On\n" * (size // 3), False),
+            ("On " + "x" * size + "\n\nwrote:", False),
+            ("Reply\n" + "> quoted line\n" * (size // 14), True),
+        ]
+        for text, quoted in texts:
+            start = time.perf_counter()
+            result = remove_quoted_text(text)
+            # the backtracking regex this replaced was quadratic on these
+            self.assertLess(time.perf_counter() - start, 5)
+            self.assertEqual(result, "Reply" if quoted else text)
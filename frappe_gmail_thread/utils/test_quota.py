@@ -0,0 +1,63 @@
+# Copyright (c) 2026, rtCamp and Contributors
+# See license.txt
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from googleapiclient.http import BatchHttpRequest
+
+from frappe_gmail_thread.utils import quota
+
+TEST_BUCKET_KEY = "gmail_quota_bucket_test"
+
+
+class TestQuota(FrappeTestCase):
+    def setUp(self):
+        frappe.cache().delete_value(TEST_BUCKET_KEY)
+        patcher = patch.object(quota, "BUCKET_KEY", TEST_BUCKET_KEY)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(frappe.cache().delete_value, TEST_BUCKET_KEY)
+
+    def test_request_units(self):
+        self.assertEqual(quota.get_method_units("gmail.users.messages.get"), 5)
+        self.assertEqual(quota.get_method_units("gmail.users.threads.get"), 10)
+        self.assertEqual(
+            quota.get_method_units("gmail.users.unknown"), quota.DEFAULT_QUOTA_UNITS
+        )
+        batch = BatchHttpRequest()
+        batch._requests = {
+            "1": SimpleNamespace(methodId="gmail.users.messages.get"),
+            "2": SimpleNamespace(methodId="gmail.users.history.list"),
+        }
+        self.assertEqual(quota.get_request_units(batch), 7)
+
+    def test_token_bucket(self):
+        # the bucket starts full, with a second's worth of units
+        self.assertEqual(quota._take(10, 10), 0)
+        wait = quota._take(10, 10)
+        self.assertGreater(wait, 0.5)
+        self.assertLessEqual(wait, 1)
+
+    def test_take_more_than_capacity(self):
+        # capped to the capacity, so a large batch is not blocked for ever
+        self.assertEqual(quota._take(100, 10), 0)
+
+    def test_acquire_waits(self):
+        with patch.object(quota, "_take", side_effect=[0.5, 0.25, 0]), patch.object(
+            quota.time, "sleep"
+        ) as sleep:
+            self.assertEqual(quota.acquire(10), 0.75)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_acquire_gives_up(self):
+        with patch.object(quota, "_take", return_value=60), patch.object(
+            quota.time, "sleep"
+        ):
+            self.assertGreaterEqual(quota.acquire(10), quota.MAX_WAIT_SECONDS)
+
+    def test_acquire_without_redis(self):
+        with patch.object(quota, "_take", side_effect=ConnectionError):
+            self.assertEqual(quota.acquire(10), 0)
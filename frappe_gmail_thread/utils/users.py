@@ -0,0 +1,74 @@
+"""Map of email addresses to desk users, kept on `frappe.local` for the job."""
+
+import time
+from typing import Dict, Iterable, List, Optional
+
+import frappe
+
+# Bumped on user changes; a job reloads its map once it sees a newer version
+VERSION_KEY = "gmail_user_map_version"
+
+# Seconds between checks of the version counter
+VERSION_CHECK_SECONDS = 30
+
+
+def _get_version() -> int:
+    try:
+        return int(frappe.cache().get(frappe.cache().make_key(VERSION_KEY)) or 0)
+    except Exception:
+        # without Redis the map is reloaded on every check
+        return -1
+
+
+def _load_user_map() -> Dict[str, str]:
+    return {
+        user.email.lower(): user.name
+        for user in frappe.get_all(
+            "User",
+            filters={"user_type": ["!=", "Website User"]},
+            fields=["name", "email"],
+        )
+        if user.email
+    }
+
+
+def get_user_map() -> Dict[str, str]:
+    """Return the map of lowercased email addresses to desk user names."""
+    cached = getattr(frappe.local, "gmail_user_map", None)
+    if cached and time.monotonic() - cached.checked_at < VERSION_CHECK_SECONDS:
+        return cached.users
+    version = _get_version()
+    if not cached or version < 0 or version != cached.version:
+        cached = frappe._dict(users=_load_user_map(), version=version)
+        frappe.local.gmail_user_map = cached
+    cached.checked_at = time.monotonic()
+    return cached.users
+
+
+def get_system_user(email: str) -> Optional[str]:
+    """Return the desk user with the given email address, if any."""
+    if not email:
+        return None
+    return get_user_map().get(email.lower())
+
+
+def get_system_users(emails: Iterable[str]) -> List[str]:
+    """Return the desk users with any of the given email addresses."""
+    user_map = get_user_map()
+    users = (user_map.get(email.lower()) for email in emails if email)
+    return list(dict.fromkeys(user for user in users if user))
+
+
+def _bump_version():
+    try:
+        frappe.cache().incr(frappe.cache().make_key(VERSION_KEY))
+    except Exception:
+        frappe.logger("gmail_sync").warning(
+            "gmail_sync: could not invalidate the user map", exc_info=True
+        )
+
+
+def invalidate_user_map():
+    """Make every job reload its map on its next check, once the change is committed."""
+    frappe.local.gmail_user_map = None
+    frappe.db.after_commit.add(_bump_version)